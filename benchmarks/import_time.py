@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""Time spent importing the core package, module by module
+
+Run from the repository root:
+  python benchmarks/import_time.py [package]
+
+Prints a report in the style of 'python -X importtime' (self and cumulative time of every
+module imported for the first time, nested by import level) and the heavy optional
+dependencies that got loaded. None of them should be needed just to import the core.
+"""
+
+import os
+import sys
+import time
+import __builtin__
+
+HEAVY = ["rdflib", "numpy", "scipy", "matplotlib", "networkx", "semanticnet"]
+
+_import = __builtin__.__import__
+_records = []
+_stack = []
+
+def _tracer(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = len(sys.modules)
+    record = [name, len(_stack), 0.0, 0.0]
+    _stack.append(record)
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        _stack.pop()
+        if _stack:
+            _stack[-1][2] += elapsed
+        if len(sys.modules)>before:
+            record[3] = elapsed
+            record[2] = elapsed - record[2]
+            _records.append(record)
+
+if __name__ == '__main__':
+    package = sys.argv[1] if len(sys.argv)>1 else "core"
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    __builtin__.__import__ = _tracer
+    start = time.time()
+    __import__(package)
+    total = time.time() - start
+    __builtin__.__import__ = _import
+    print "import time: self [us] | cumulative | imported package"
+    for name, depth, self_time, cumulative in _records:
+        print "import time: {:>9} | {:>10} | {}{}".format(int(self_time*1e6), int(cumulative*1e6), "  "*depth, name)
+    print "\n'import {}' took {:.1f} ms".format(package, total*1000)
+    loaded = [m for m in HEAVY if m in sys.modules]
+    print "Heavy modules loaded: {}".format(", ".join(loaded) if loaded else "none")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""Memory used by N independent world models hosted in the same process
+
+Run from the repository root:
+  python benchmarks/scenes_memory.py [max_scenes]
+
+Every scene is a copy of the demo lab. The resident memory per scene should stay
+roughly constant as the number of scenes grows.
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import core as skiros
+
+def rss():
+    """
+    Current resident memory of the process, in KB
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def buildScene(name, boxes=20):
+    wm = skiros.wm.WorldModel(name)
+    robot = skiros.wm.Element("Agent", "robot")
+    wm.addElement(robot, 0, "contain")
+    location = skiros.wm.Element("Location", "unknown")
+    wm.addElement(location, 0, "contain")
+    wm.setRelation(robot._id, "robotAt", location._id, True)
+    arm = skiros.wm.Element("Arm", "ur10")
+    wm.addElement(arm, robot._id, "contain")
+    gripper = skiros.wm.Element("Gripper", "rq3")
+    wm.addElement(gripper, arm._id, "contain")
+    camera = skiros.wm.Element("Camera", "wrist_camera")
+    wm.addElement(camera, arm._id, "contain")
+    kit = skiros.wm.Element("Kit", "kitting_box")
+    wm.addElement(kit, robot._id, "contain")
+    for i in range(boxes):
+        cell = skiros.wm.Element("Cell", "cell_{}".format(i))
+        wm.addElement(cell, kit._id, "contain")
+        box = skiros.wm.Element("LargeBox", "box_{}".format(i))
+        box.addProperty("Position", 1.0*i)
+        wm.addElement(box, 0, "contain")
+        wm.setRelation(camera._id, "hasViewOn", box._id, True)
+    return wm
+
+if __name__ == '__main__':
+    max_scenes = int(sys.argv[1]) if len(sys.argv)>1 else 256
+    scenes = []
+    base = rss()
+    n = 1
+    print "{:>8} {:>12} {:>14}".format("scenes", "rss (KB)", "KB per scene")
+    while n <= max_scenes:
+        while len(scenes) < n:
+            scenes.append(buildScene("scene_{}".format(len(scenes))))
+        used = rss() - base
+        print "{:>8} {:>12} {:>14.1f}".format(n, used, float(used)/n)
+        n *= 2
+    #The scenes must not share any state
+    for i, wm in enumerate(scenes):
+        assert wm.getElement(0)._label == "scene_{}".format(i)
+        assert len(wm.resolveElement(skiros.wm.Element("LargeBox"))) == 20
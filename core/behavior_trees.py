@@ -78,6 +78,8 @@ class Parallel():
     def processChildren(self, children, visitor):
         """
         Parallel executor - return on first fail, or return success
+        
+        Children run on threads: a world model shared by the children must be set thread safe (WorldModel.setThreadSafe)
         """
         result = Value('b', True)
         barrier = Barrier()
@@ -1,16 +1,30 @@
 import params
 import world_model as wm
-from copy import deepcopy
+import time
+import weakref
+from collections import OrderedDict
+from threading import Lock
 
 class ConditionBase(object):
     """
+    Conditions are immutable: parameters and world model are passed to each call, and setTrue returns the
+    undo record to give back to revert. A condition can be shared by many procedures and evaluated concurrently
     """    
+    #Relative cost of an evaluation, cheaper conditions are checked first
+    _cost = 0
+    _hash = None
+    
     def __init__(self, clabel, subj, desired_state):            
         self._desired_state=desired_state                           
         self._subject_key=subj  
         self._label=clabel  
         self._description=""        
           
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self._getIdentity())
+        return self._hash
+        
     def __eq__(self, other):
         if self.isEqual(other):
             return True
@@ -23,11 +37,30 @@ class ConditionBase(object):
         else:
             return True
         
+    def __copy__(self):
+        return self
+        
+    def __deepcopy__(self, memo):
+        return self
+        
+    def _replace(self, **attributes):
+        """
+        Return a copy of the condition with some attributes changed
+        """
+        to_ret = object.__new__(self.__class__)
+        to_ret.__dict__.update(self.__dict__)
+        to_ret.__dict__.update(attributes)
+        to_ret._hash = None
+        to_ret._setDescription()
+        return internCondition(to_ret)
+        
     def remap(self, initial_key, target_key):
+        """
+        Return the condition with the key remapped (the condition itself if it doesn't use the key)
+        """
         if self._subject_key==initial_key:
-            self._subject_key=target_key
-            self._setDescription()
-            #print "New description: " + self.getDescription()
+            return self._replace(_subject_key=target_key)
+        return self
           
     def getParamIndex(self, key):
         l = [i for i, x in enumerate(self.getKeys()) if key==x]
@@ -36,11 +69,8 @@ class ConditionBase(object):
         else:
             return -1
     
-    def getParamId(self, key):
-        if self._params:
-            return self._params.getParamValue(key)._id
-        else:
-            raise
+    def getParamId(self, ph, key):
+        return ph.getParamValue(key)._id
     
     def getKeys(self):
         return [self._subject_key]
@@ -52,42 +82,45 @@ class ConditionBase(object):
         """ Not implemented in abstract class. """
         raise NotImplementedError("Not implemented in abstract class")
     def evaluate(self, ph, wmi):
-        """ Not implemented in abstract class. """
+        return self._check(wmi, *[ph.getParam(key) for key in self.getKeys()])
+    def _check(self, wmi, *parameters):
+        """ Evaluate the condition, given the parameters of its keys. """
         raise NotImplementedError("Not implemented in abstract class")
     def setTrue(self, ph, wmi):
-        """ Not implemented in abstract class. """
+        """ Return the undo record for revert, or None if the condition can't be set. """
         raise NotImplementedError("Not implemented in abstract class")
-    def revert(self):
-        """ Not implemented in abstract class. """
+    def revert(self, ph, wmi, record):
+        """ Undo setTrue, given its undo record. """
         raise NotImplementedError("Not implemented in abstract class")
     def setDesiredState(self, ph):
         """ Used to resolve the element in the world model. """
         raise NotImplementedError("Not implemented in abstract class")
+    def _getIdentity(self):
+        """ Return the tuple identifying the condition: two conditions are equal if their identities are equal. """
+        raise NotImplementedError("Not implemented in abstract class")
     def isEqual(self, other):
         """ Equality function. """
-        raise NotImplementedError("Not implemented in abstract class")
+        return isinstance(other, ConditionBase) and self._getIdentity()==other._getIdentity()
     
     
 class ConditionProperty(ConditionBase):
+    _cost = 1
+    
     def __init__(self, clabel, olabel, subj, value, desired_state):            
         self._desired_state=desired_state                           
         self._subject_key=subj          
         self._value=value 
         self._label=clabel          
         self._owl_label=olabel
-        self._params = None
         self._setDescription()
                  
-    def isEqual(self, other):
-        if isinstance(other, ConditionProperty):
-            return self._subject_key==other._subject_key and self._owl_label==other._owl_label and self._value==other._value and self._desired_state==other._desired_state 
-        else:
-            return False 
+    def _getIdentity(self):
+        return (self.__class__, self._subject_key, self._owl_label, self._value, self._desired_state)
             
-    def hasConflict(self, other):
+    def hasConflict(self, other, ph, other_ph):
         if isinstance(other, ConditionProperty):
             if self._owl_label==other._owl_label and self._value==other._value and self._desired_state!=other._desired_state:
-                return self.getParamId(self._subject_key)==other.getParamId(other._subject_key) or self._subject_key==other._subject_key
+                return self.getParamId(ph, self._subject_key)==other.getParamId(other_ph, other._subject_key) or self._subject_key==other._subject_key
         return False 
             
     def _setDescription(self):  
@@ -97,13 +130,11 @@ class ConditionProperty(ConditionBase):
                               self._value, 
                               self._desired_state) 
         
-    def evaluate(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
+    def _check(self, wmi, sparam):
+        subj = sparam.getValue()
         #print self._description + "\n{}".format(subj.printState(True))
         if subj._id < 0:
-            if self._params.getParam(self._subject_key).paramType()==params.ParamTypes.Optional:#If optional return true, else return false
+            if sparam.paramType()==params.ParamTypes.Optional:#If optional return true, else return false
                 return True
             else:
                 return False
@@ -116,33 +147,31 @@ class ConditionProperty(ConditionBase):
         return not self._desired_state
         
     def setTrue(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
+        subj = ph.getParamValue(self._subject_key)
         if subj._id < 0:
-            return False
-        self._has_cache = True
-        self._cache = deepcopy(subj)
-        if self._desired_state:
-            if not subj.hasValue(self._owl_label, self._value):
+            return None
+        if subj.hasValue(self._owl_label, self._value)==self._desired_state:
+            return ()
+        wmi.startTransaction()
+        try:
+            if self._desired_state:
                 subj.appendProperty(self._owl_label, self._value)
-        else:
-            while subj.hasValue(self._owl_label, self._value):
-                subj.removePropertyValue(self._owl_label, self._value)
-        self._params.specify(self._subject_key, subj)
-        self._wm.updateElement(subj)
-        return True
+            else:
+                while subj.hasValue(self._owl_label, self._value):
+                    subj.removePropertyValue(self._owl_label, self._value)
+            ph.specify(self._subject_key, subj)
+            wmi.updateElement(subj)
+        except:
+            wmi.rollbackTransaction()
+            raise
+        return (subj._id, wmi.commitTransaction())
         
-    def revert(self, ph, wmi):
-        if self._has_cache:
-            self._params = ph
-            self._wm = wmi
-            #print self._description + "\n{}".format(self._cache.printState(True))
-            self._params.specify(self._subject_key, self._cache)
-            self._wm.updateElement(self._cache)
-            self._has_cache = False
-            return True            
-        return False
+    def revert(self, ph, wmi, record):
+        if record:
+            eid, journal = record
+            wmi.revertJournal(journal)
+            ph.specify(self._subject_key, wmi.getElement(eid))
+        return True
         
     def setDesiredState(self, ph):
         e = ph.getParamValue(self._subject_key)
@@ -155,36 +184,34 @@ class ConditionProperty(ConditionBase):
                 e.removePropertyValue(self._owl_label, self._value)
            
 class ConditionRelation(ConditionBase):
+    _cost = 3
+    
     def __init__(self, clabel, olabel, subj, obj, desired_state):  
         self._desired_state=desired_state                           
         self._subject_key=subj                                   
         self._object_key=obj      
         self._label=clabel          
         self._owl_label=olabel
-        self._params = None
         self._setDescription()
         
     def remap(self, initial_key, target_key):
         if self._subject_key==initial_key:
-            self._subject_key=target_key
+            return self._replace(_subject_key=target_key)
         elif self._object_key==initial_key:
-            self._object_key=target_key
-        self._setDescription()
+            return self._replace(_object_key=target_key)
+        return self
             
     def getKeys(self):
         return [self._subject_key, self._object_key]
                          
-    def isEqual(self, other):
-        if isinstance(other, ConditionRelation):
-            return self._subject_key==other._subject_key and self._owl_label==other._owl_label and self._object_key==other._object_key and self._desired_state==other._desired_state 
-        else:
-            return False
+    def _getIdentity(self):
+        return (self.__class__, self._subject_key, self._owl_label, self._object_key, self._desired_state)
             
-    def hasConflict(self, other):
+    def hasConflict(self, other, ph, other_ph):
         if isinstance(other, ConditionRelation):
             if self._owl_label==other._owl_label and self._desired_state!=other._desired_state:
-                #print "{}=={} and {}=={}".format(self.getParamId(self._subject_key), other.getParamId(other._subject_key), self.getParamId(self._object_key), other.getParamId(other._object_key))
-                return (self.getParamId(self._subject_key)==other.getParamId(other._subject_key) and self.getParamId(self._object_key)==other.getParamId(other._object_key)) or (self._subject_key==other._subject_key and self._object_key==other._object_key)
+                #print "{}=={} and {}=={}".format(self.getParamId(ph, self._subject_key), other.getParamId(other_ph, other._subject_key), self.getParamId(ph, self._object_key), other.getParamId(other_ph, other._object_key))
+                return (self.getParamId(ph, self._subject_key)==other.getParamId(other_ph, other._subject_key) and self.getParamId(ph, self._object_key)==other.getParamId(other_ph, other._object_key)) or (self._subject_key==other._subject_key and self._object_key==other._object_key)
         return False
             
     def _setDescription(self):  
@@ -194,53 +221,40 @@ class ConditionRelation(ConditionBase):
                               self._object_key, 
                               self._desired_state) 
                                       
-    def evaluate(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
-        obj = self._params.getParamValue(self._object_key)
+    def _check(self, wmi, sparam, oparam):
+        subj = sparam.getValue()
+        obj = oparam.getValue()
         #print self._description + "{} {}".format(subj.printState(), obj.printState())
         if subj._id < 0 or obj._id < 0:
-            ps = self._params.getParam(self._subject_key)
-            po = self._params.getParam(self._object_key)
-            if ((subj._id < 0 and ps.paramType()==params.ParamTypes.Optional) or (obj._id < 0 and po.paramType()==params.ParamTypes.Optional)):
+            if ((subj._id < 0 and sparam.paramType()==params.ParamTypes.Optional) or (obj._id < 0 and oparam.paramType()==params.ParamTypes.Optional)):
                 return True
             else:
                 return False
-        v = self._wm.getRelations(subj._id, self._owl_label, obj._id)
+        v = wmi.getRelations(subj._id, self._owl_label, obj._id)
         if v:
             return self._desired_state
         else:
             return not self._desired_state
         
     def setTrue(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
-        obj = self._params.getParamValue(self._object_key)
+        subj = ph.getParamValue(self._subject_key)
+        obj = ph.getParamValue(self._object_key)
         if subj._id < 0 or obj._id < 0:
-            return False
-        #print self._description + "{} {}".format(subj.printState(), obj.printState())
-        self._has_cache = True
-        self._cache = self._wm.getRelations(-1, "", obj._id)
+            return None
         #print self._description + "{} {}".format(subj.printState(), obj.printState())
-        if not self._wm.setRelation(subj._id, self._owl_label, obj._id, self._desired_state):
-            return False
-        return True
+        wmi.startTransaction()
+        try:
+            #Checked in the transaction, so no other writer can change the relation before it is set
+            if bool(wmi.getRelations(subj._id, self._owl_label, obj._id))!=self._desired_state:
+                wmi.setRelation(subj._id, self._owl_label, obj._id, self._desired_state)
+        except:
+            wmi.rollbackTransaction()
+            raise
+        return wmi.commitTransaction()
         
-    def revert(self, ph, wmi):
-        if self._has_cache:
-            self._params = ph
-            self._wm = wmi
-            subj = self._params.getParamValue(self._subject_key)
-            obj = self._params.getParamValue(self._object_key)
-            #print self._description + "{} {}".format(subj.printState(), obj.printState())
-            self._wm.setRelation(subj._id, self._owl_label, obj._id, not self._desired_state)
-            for edge in self._cache:
-                self._wm.setRelation(edge['src'], edge['type'], edge['dst'], True)
-            self._has_cache = False      
-            return True
-        return False
+    def revert(self, ph, wmi, record):
+        wmi.revertJournal(record)
+        return True
         
     def setDesiredState(self, ph):
         subj = ph.getParamValue(self._subject_key)
@@ -251,24 +265,22 @@ class ConditionRelation(ConditionBase):
             obj.addRelation(self._subject_key, self._owl_label, -1, self._desired_state)
 
 class ConditionHasProperty(ConditionBase):
+    _cost = 1
+    
     def __init__(self, clabel, olabel, subj, desired_state):            
         self._desired_state=desired_state                           
         self._subject_key=subj      
         self._label=clabel          
         self._owl_label=olabel
-        self._params = None
         self._setDescription()
 
-    def isEqual(self, other):
-        if isinstance(other, ConditionHasProperty):
-            return self._subject_key==other._subject_key and self._owl_label==other._owl_label and self._desired_state==other._desired_state 
-        else:
-            return False
+    def _getIdentity(self):
+        return (self.__class__, self._subject_key, self._owl_label, self._desired_state)
             
-    def hasConflict(self, other):
+    def hasConflict(self, other, ph, other_ph):
         if isinstance(other, ConditionHasProperty):
             if self._owl_label==other._owl_label and self._desired_state!=other._desired_state:
-                return self.getParamId(self._subject_key)==other.getParamId(other._subject_key) or self._subject_key==other._subject_key
+                return self.getParamId(ph, self._subject_key)==other.getParamId(other_ph, other._subject_key) or self._subject_key==other._subject_key
         return False
         
     def _setDescription(self):  
@@ -277,13 +289,11 @@ class ConditionHasProperty(ConditionBase):
                               self._owl_label, 
                               self._desired_state) 
         
-    def evaluate(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
+    def _check(self, wmi, sparam):
+        subj = sparam.getValue()
         #print self._description + "\n{}".format(subj.printState(True))
         if subj._id < 0:
-            if self._params.getParam(self._subject_key).paramType()==params.ParamTypes.Optional:#If optional return true, else return false
+            if sparam.paramType()==params.ParamTypes.Optional:#If optional return true, else return false
                 return True
             else:
                 return False
@@ -293,33 +303,30 @@ class ConditionHasProperty(ConditionBase):
             return not self._desired_state
         
     def setTrue(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
+        subj = ph.getParamValue(self._subject_key)
         if subj._id < 0:
-            return False
-        self._has_cache = True
-        self._cache = deepcopy(subj)
-        if self._desired_state:
-            if not subj.hasProperty(self._owl_label):
+            return None
+        if subj.hasProperty(self._owl_label)==self._desired_state:
+            return ()
+        wmi.startTransaction()
+        try:
+            if self._desired_state:
                 subj.addProperty(self._owl_label, "")
-        else:
-            if subj.hasProperty(self._owl_label):
+            else:
                 subj.removeProperty(self._owl_label)
-        self._params.specify(self._subject_key, subj)
-        self._wm.updateElement(subj)
-        return True
+            ph.specify(self._subject_key, subj)
+            wmi.updateElement(subj)
+        except:
+            wmi.rollbackTransaction()
+            raise
+        return (subj._id, wmi.commitTransaction())
         
-    def revert(self, ph, wmi):
-        if self._has_cache:
-            self._params = ph
-            self._wm = wmi
-            self._params.specify(self._subject_key, self._cache)
-            #print self._description + " {}".format(self._cache.printState())
-            self._wm.updateElement(self._cache)
-            self._has_cache = False
-            return True            
-        return False
+    def revert(self, ph, wmi, record):
+        if record:
+            eid, journal = record
+            wmi.revertJournal(journal)
+            ph.specify(self._subject_key, wmi.getElement(eid))
+        return True
         
     def setDesiredState(self, ph):
         e = ph.getParamValue(self._subject_key)
@@ -333,20 +340,18 @@ class ConditionHasProperty(ConditionBase):
         
       
 class ConditionIsSpecified(ConditionBase):  
+    _cost = 0
+    
     def __init__(self, clabel, subj, desired_state):
         self._subject_key=subj      
         self._label=clabel   
         self._desired_state=desired_state  
-        self._params = None 
         self._setDescription()
               
-    def isEqual(self, other):
-        if isinstance(other, ConditionIsSpecified):
-            return self._subject_key==other._subject_key and self._desired_state==other._desired_state 
-        else:
-            return False
+    def _getIdentity(self):
+        return (self.__class__, self._subject_key, self._desired_state)
             
-    def hasConflict(self, other):
+    def hasConflict(self, other, ph, other_ph):
         if isinstance(other, ConditionIsSpecified):
             return self._subject_key==other._subject_key and self._desired_state!=other._desired_state 
         else:
@@ -357,10 +362,8 @@ class ConditionIsSpecified(ConditionBase):
                               self._subject_key, 
                               self._desired_state) 
                                   
-    def evaluate(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
+    def _check(self, wmi, sparam):
+        subj = sparam.getValue()
         if subj._id >= 0 and self._desired_state:
             return True
         elif subj._id < 0 and not self._desired_state:
@@ -369,51 +372,38 @@ class ConditionIsSpecified(ConditionBase):
             return False
         
     def setTrue(self, ph, wmi):     
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
-        self._has_cache = True
-        self._cache = deepcopy(subj)
+        subj = ph.getParamValue(self._subject_key)
+        #The only change is the element bound to the parameter (or its id): remember the original and its id
+        record = (subj, subj._id)
         if subj._id < 0 and self._desired_state:
-            self._cache_new = wm.Element(subj._type, "==FAKE==")
-            self._params.specify(self._subject_key, self._cache_new)
-            self._cache_new = deepcopy(self._cache_new)
+            ph.specify(self._subject_key, wm.Element(subj._type, "==FAKE=="))
         elif subj._id >= 0 and not self._desired_state:
             subj._id = -1
-            self._cache_new = subj
-            self._params.specify(self._subject_key, self._cache_new)
-        else:
-            self._cache_new = self._cache
-        return True
+            ph.specify(self._subject_key, subj)
+        return record
         
-    def revert(self, ph, wmi):
-        if self._has_cache:
-            self._params = ph
-            self._wm = wmi
-            #print self._description + " {}".format(self._cache.printState())
-            self._params.specify(self._subject_key, self._cache)
-            self._has_cache = False
-            return True            
-        return False
+    def revert(self, ph, wmi, record):
+        subj, eid = record
+        subj._id = eid
+        ph.specify(self._subject_key, subj)
+        return True
         
     def setDesiredState(self, ph):
         return
               
 class ConditionGenerate(ConditionBase):  
+    _cost = 0
+    
     def __init__(self, clabel, subj, desired_state):
         self._subject_key=subj      
         self._label=clabel   
         self._desired_state=desired_state  
-        self._params = None 
         self._setDescription()
                
-    def isEqual(self, other):
-        if isinstance(other, ConditionGenerate):
-            return self._subject_key==other._subject_key and self._desired_state==other._desired_state 
-        else:
-            return False
+    def _getIdentity(self):
+        return (self.__class__, self._subject_key, self._desired_state)
              
-    def hasConflict(self, other):
+    def hasConflict(self, other, ph, other_ph):
         if isinstance(other, ConditionGenerate):
             return self._subject_key==other._subject_key and self._desired_state!=other._desired_state 
         else:
@@ -424,10 +414,8 @@ class ConditionGenerate(ConditionBase):
                               self._subject_key, 
                               self._desired_state) 
                                   
-    def evaluate(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
+    def _check(self, wmi, sparam):
+        subj = sparam.getValue()
         if subj._id >= 0 and self._desired_state:
             return True
         elif subj._id < 0 and not self._desired_state:
@@ -436,59 +424,48 @@ class ConditionGenerate(ConditionBase):
             return False
         
     def setTrue(self, ph, wmi):     
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
-        self._has_cache = True
-        self._cache = deepcopy(subj)
-        #print subj.printState(True)
-        if subj._id < 0 and self._desired_state:
-            self._cache_new = wm.Element(subj._type, "==FAKE==")
-            self._wm.addElement(self._cache_new, 0, "contain")
-            #print self._wm.printModel()
-            self._params.specify(self._subject_key, self._cache_new)
-            self._cache_new = deepcopy(self._cache_new)
-        elif subj._id >= 0 and not self._desired_state:
-            self._wm.removeElement(subj._id)
-            subj._id = -1
-            self._cache_new = subj
-            self._params.specify(self._subject_key, self._cache_new)
-        else:
-            self._cache_new = self._cache
-        return True
+        subj = ph.getParamValue(self._subject_key)
+        record = (subj, subj._id)
+        wmi.startTransaction()
+        try:
+            #print subj.printState(True)
+            if subj._id < 0 and self._desired_state:
+                new = wm.Element(subj._type, "==FAKE==")
+                wmi.addElement(new, 0, "contain")
+                #print wmi.printModel()
+                ph.specify(self._subject_key, new)
+            elif subj._id >= 0 and not self._desired_state:
+                wmi.removeElement(subj._id)
+                subj._id = -1
+                ph.specify(self._subject_key, subj)
+        except:
+            wmi.rollbackTransaction()
+            raise
+        return record + (wmi.commitTransaction(),)
         
-    def revert(self, ph, wmi):
-        if self._has_cache:
-            self._params = ph
-            self._wm = wmi
-            #print self._description + " {}".format(self._cache_new.printState())
-            if self._cache_new._id>=0 and self._cache._id<0:
-                self._wm.removeElement(self._cache_new._id)
-            elif self._cache_new._id<0 and self._cache._id>=0:
-                self._wm.addElement(self._cache, 0, "contain")
-            self._params.specify(self._subject_key, self._cache)
-            self._has_cache = False
-            return True            
-        return False
+    def revert(self, ph, wmi, record):
+        subj, eid, journal = record
+        wmi.revertJournal(journal)
+        subj._id = eid
+        ph.specify(self._subject_key, subj)
+        return True
         
     def setDesiredState(self, ph):
         return
         
 class ConditionOnType(ConditionBase):  
+    _cost = 2
+    
     def __init__(self, clabel, subj, value):
         self._subject_key=subj      
         self._label=clabel   
         self._value=value  
-        self._params = None 
         self._setDescription()
                
-    def isEqual(self, other):
-        if isinstance(other, ConditionOnType):
-            return self._subject_key==other._subject_key and self._value==other._value 
-        else:
-            return False
+    def _getIdentity(self):
+        return (self.__class__, self._subject_key, self._value)
              
-    def hasConflict(self, other):
+    def hasConflict(self, other, ph, other_ph):
         if isinstance(other, ConditionOnType):
             return self._subject_key==other._subject_key
         else:
@@ -499,19 +476,17 @@ class ConditionOnType(ConditionBase):
                               self._subject_key, 
                               self._value) 
                                   
-    def evaluate(self, ph, wmi):
-        self._params = ph
-        self._wm = wmi
-        subj = self._params.getParamValue(self._subject_key)
+    def _check(self, wmi, sparam):
+        subj = sparam.getValue()
         if wmi.isOfType(subj, self._value):
             return True
         else:
             return False
         
     def setTrue(self, ph, wmi):   
-        return True
+        return ()
         
-    def revert(self, ph, wmi):       
+    def revert(self, ph, wmi, record):       
         return True
         
     def setDesiredState(self, ph):
@@ -519,4 +494,164 @@ class ConditionOnType(ConditionBase):
         if e._id>=0: 
             return
         else: 
-            e._type = self._value
\ No newline at end of file
+            e._type = self._value            
+_interned = weakref.WeakValueDictionary()
+
+def internCondition(condition):
+    """
+    Return the canonical instance of the condition: equal conditions with the same label are the same object
+    """
+    return _interned.setdefault((condition._getIdentity(), condition._label), condition)
+            
+class ConditionPlan(object):
+    """
+    A list of conditions compiled for evaluation
+
+    The keys are resolved once for all the conditions. A full check evaluates the conditions in their order,
+    a boolean check stops at the first failure.
+
+    Each condition counts its evaluations and failures, and times one evaluation every _sample_period to
+    estimate its cost. The boolean check starts from the cheapest conditions (with the conditions on the
+    same subject next to each other), then every _reorder_period checks it moves first the conditions with
+    the lowest cost per rejection
+    """
+    _reorder_period = 32
+    _sample_period = 16
+    
+    def __init__(self, conditions):
+        self._conditions = tuple(conditions)
+        self._keys = []
+        self._steps = []
+        for c in self._conditions:
+            indexes = []
+            for key in c.getKeys():
+                if not key in self._keys:
+                    self._keys.append(key)
+                indexes.append(self._keys.index(key))
+            self._steps.append((c, tuple(indexes)))
+        #Evaluations, failures, timed evaluations and seconds spent in them, for each condition
+        self._stats = [[0, 0, 0, 0.0] for _ in self._steps]
+        self._order = sorted(range(len(self._steps)), key=lambda i: (self._steps[i][0]._cost, self._steps[i][1]))
+        self._checks = 0
+        
+    def _resolve(self, ph):
+        pmap = ph.getParamMap()
+        return [pmap[key] if key in pmap else ph.getParam(key) for key in self._keys]
+        
+    def _evaluate(self, i, wmi, parameters):
+        c, indexes = self._steps[i]
+        #Counters are not locked: with concurrent checks they are approximated
+        stats = self._stats[i]
+        if stats[0] % self._sample_period:
+            result = c._check(wmi, *[parameters[j] for j in indexes])
+        else:
+            start = time.time()
+            result = c._check(wmi, *[parameters[j] for j in indexes])
+            stats[3] += time.time() - start
+            stats[2] += 1
+        stats[0] += 1
+        if not result:
+            stats[1] += 1
+        return result
+        
+    def _rank(self, i):
+        """
+        Expected time spent to find a failure, starting from this condition. Never evaluated conditions go first
+        """
+        evaluations, failures, timed, elapsed = self._stats[i]
+        if not evaluations:
+            return 0.0
+        return (elapsed/timed) / ((failures+1.0)/(evaluations+2.0))
+        
+    def _reorder(self):
+        self._order = sorted(self._order, key=self._rank)
+        
+    def getFailed(self, ph, wmi):
+        """
+        Return the indexes of the conditions that don't hold
+        """
+        parameters = self._resolve(ph)
+        return [i for i in range(len(self._steps)) if not self._evaluate(i, wmi, parameters)]
+        
+    def holds(self, ph, wmi):
+        """
+        Return true if all the conditions hold
+        """
+        parameters = self._resolve(ph)
+        self._checks += 1
+        if self._checks % self._reorder_period == 0:
+            self._reorder()
+        for i in self._order:
+            if not self._evaluate(i, wmi, parameters):
+                return False
+        return True
+        
+    def getStatistics(self):
+        """
+        Return a list of (condition, evaluations, failures, seconds spent). The seconds are estimated from
+        the timed evaluations
+        """
+        return [(c, evaluations, failures, elapsed*evaluations/timed if timed else 0.0)
+                for (c, _), (evaluations, failures, timed, elapsed) in zip(self._steps, self._stats)]
+        
+_plans = OrderedDict()
+_plans_mutex = Lock()
+_max_plans = 1024
+
+def getPlan(conditions):
+    """
+    Return the evaluation plan of a list of conditions. Plans are compiled once and shared by all the
+    procedures with the same conditions. When there are more than _max_plans, the least recently used is dropped
+    """
+    key = tuple(conditions)
+    with _plans_mutex:
+        plan = _plans.pop(key, None)
+        if plan is None:
+            if len(_plans)>=_max_plans:
+                _plans.popitem(last=False)
+            plan = ConditionPlan(key)
+        #Reinserted at the end, the most recently used
+        _plans[key] = plan
+    return plan
+    
+def getStatistics():
+    """
+    Return the evaluation statistics of the conditions, merged by description and sorted by total time spent
+    
+    Each entry is a dictionary with: description, evaluations, failures, failure_rate, mean_cost (seconds), total_cost (seconds)
+    """
+    merged = {}
+    with _plans_mutex:
+        plans = _plans.values()
+    for plan in plans:
+        for c, evaluations, failures, elapsed in plan.getStatistics():
+            stats = merged.setdefault(c.getDescription(), [0, 0, 0.0])
+            stats[0] += evaluations
+            stats[1] += failures
+            stats[2] += elapsed
+    to_ret = []
+    for description, (evaluations, failures, elapsed) in merged.iteritems():
+        if evaluations:
+            to_ret.append({"description": description,
+                           "evaluations": evaluations,
+                           "failures": failures,
+                           "failure_rate": float(failures)/evaluations,
+                           "mean_cost": elapsed/evaluations,
+                           "total_cost": elapsed})
+    to_ret.sort(key=lambda s: s["total_cost"], reverse=True)
+    return to_ret
+    
+def writeStatistics(stream):
+    """
+    Write the evaluation statistics of the conditions as a tab separated table
+    """
+    stream.write("condition\tevaluations\tfailure rate\tmean cost [us]\ttotal cost [ms]\n")
+    for s in getStatistics():
+        stream.write("{}\t{}\t{:.3f}\t{:.1f}\t{:.3f}\n".format(s["description"], s["evaluations"], s["failure_rate"], s["mean_cost"]*1e6, s["total_cost"]*1e3))
+    
+def resetStatistics():
+    """
+    Forget the compiled plans and their statistics
+    """
+    with _plans_mutex:
+        _plans.clear()
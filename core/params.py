@@ -1,5 +1,4 @@
 from flufl.enum import Enum 
-import numpy as np
 from copy import deepcopy
 import logger.logger as log
 
@@ -0,0 +1,184 @@
+"""
+Persistent (structurally shared) containers used as world model storage
+
+A fork shares the whole content with the original in O(1). Both sides then write in a private layer,
+so they evolve independently without copying what they don't modify.
+"""
+
+_MISSING = object()
+_DELETED = object()
+
+class PMap(object):
+    """
+    A dictionary that can be forked in O(1)
+
+    The content is a chain of layers: the private layer on top, written by this map, and the frozen
+    layers below, shared with the forks. A lookup walks the chain, so the chain gets flattened when it
+    grows deeper than _max_depth.
+
+    Values stored in a frozen layer are shared: containers stored as values must be modified only
+    through 'mutable', that forks them before the first write.
+    """
+    _max_depth = 16
+
+    def __init__(self, items=None):
+        self._data = {}
+        self._base = None
+        self._depth = 0
+        self._size = 0
+        if items:
+            for k, v in items:
+                self[k] = v
+
+    def _lookup(self, key):
+        v = self._data.get(key, _MISSING)
+        base = self._base
+        while v is _MISSING and base is not None:
+            v = base[0].get(key, _MISSING)
+            base = base[1]
+        if v is _DELETED:
+            return _MISSING
+        return v
+
+    def _inBase(self, key):
+        base = self._base
+        while base is not None:
+            v = base[0].get(key, _MISSING)
+            if v is not _MISSING:
+                return v is not _DELETED
+            base = base[1]
+        return False
+
+    def _flatten(self):
+        """
+        Merge all the layers in a single frozen layer
+        """
+        self._data = dict(self.iteritems())
+        self._base = None
+        self._depth = 0
+
+    def fork(self):
+        """
+        Return an independent copy of the map, sharing the current content
+        """
+        if self._data:
+            if self._depth>=self._max_depth:
+                self._flatten()
+            self._base = (self._data, self._base)
+            self._depth += 1
+            self._data = {}
+        to_ret = self.__class__()
+        to_ret._base = self._base
+        to_ret._depth = self._depth
+        to_ret._size = self._size
+        return to_ret
+
+    def get(self, key, default=None):
+        v = self._lookup(key)
+        if v is _MISSING:
+            return default
+        return v
+
+    def mutable(self, key, factory):
+        """
+        Return the value stored at key, ready to be modified in place. If missing, it is created with factory
+        """
+        v = self._data.get(key, _MISSING)
+        if v is _MISSING or v is _DELETED:
+            v = self._lookup(key)
+            if v is _MISSING:
+                v = factory()
+                self._size += 1
+            else:
+                v = v.fork()
+            self._data[key] = v
+        return v
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def __getitem__(self, key):
+        v = self._lookup(key)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key, value):
+        if self._lookup(key) is _MISSING:
+            self._size += 1
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        if self._lookup(key) is _MISSING:
+            raise KeyError(key)
+        self._size -= 1
+        if self._inBase(key):
+            self._data[key] = _DELETED
+        else:
+            del self._data[key]
+
+    def pop(self, key, default=_MISSING):
+        v = self._lookup(key)
+        if v is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        del self[key]
+        return v
+
+    def __len__(self):
+        return self._size
+
+    def __nonzero__(self):
+        return self._size>0
+
+    def iteritems(self):
+        if self._base is None:
+            for k, v in self._data.iteritems():
+                if v is not _DELETED:
+                    yield k, v
+            return
+        seen = set()
+        layer = (self._data, self._base)
+        while layer is not None:
+            for k, v in layer[0].iteritems():
+                if not k in seen:
+                    seen.add(k)
+                    if v is not _DELETED:
+                        yield k, v
+            layer = layer[1]
+
+    def iterkeys(self):
+        for k, _ in self.iteritems():
+            yield k
+
+    def itervalues(self):
+        for _, v in self.iteritems():
+            yield v
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+class PSet(PMap):
+    """
+    A set that can be forked in O(1)
+    """
+    def add(self, key):
+        v = self._data.get(key, _MISSING)
+        if v is True or (v is _MISSING and self._inBase(key)):
+            return
+        self._data[key] = True
+        self._size += 1
+
+    def discard(self, key):
+        if key in self:
+            del self[key]
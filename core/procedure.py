@@ -23,9 +23,9 @@ class ProcedureBase:
     def setDescription(self, typein, paramsin, prein, holdin, postin):
         self._type = copy(typein) 
         self._params = deepcopy(paramsin)
-        self._pre_conditions = deepcopy(prein)
-        self._hold_conditions = deepcopy(holdin)
-        self._post_conditions = deepcopy(postin)
+        self._pre_conditions = list(prein)
+        self._hold_conditions = list(holdin)
+        self._post_conditions = list(postin)
         
     def createDescription(self):
         """ Not implemented in abstract class. """
@@ -60,22 +60,22 @@ class ProcedureBase:
         #self.addPreCondition(self.getRelationCond("HasSkill", "hasSkill", "Robot", "Skill", True))
         #for key, param in self._params.getParamMapFiltered(params.ParamTypes.Hardware).iteritems():
         #    self.addPreCondition(self.getPropCond("DeviceIdle", "deviceState", key, "Idle", True))
+        pre = set(self._pre_conditions)
         for key, param in self._params.getParamMapFiltered([params.ParamTypes.Online, params.ParamTypes.Offline]).iteritems():
             if param.valueType() == type(wm.Element()): 
                 c1 = self.getIsSpecifiedCond("Has"+key, key, True)                   
-                dont_add = False
-                for c2 in self._pre_conditions:
-                    if c1.isEqual(c2):
-                        dont_add = True
-                if not dont_add: self.addPreCondition(c1)
+                if not c1 in pre: 
+                    self.addPreCondition(c1)
+                    pre.add(c1)
+        post = set(self._post_conditions)
+        #A generate condition conflicts with the ones on the same key with opposite desired state
+        removed = set(c._subject_key for c in self._post_conditions if isinstance(c, cond.ConditionGenerate) and not c._desired_state)
         for key, param in self._params.getParamMapFiltered(params.ParamTypes.Optional).iteritems():
             if param.valueType() == type(wm.Element()):
                 c1 = self.getGenerateCond("Has"+key, key, True)                   
-                dont_add = False
-                for c2 in self._post_conditions:
-                    if c1.isEqual(c2) or c1.hasConflict(c2):
-                        dont_add = True
-                if not dont_add: self._post_conditions = [c1] + self._post_conditions
+                if not c1 in post and not key in removed: 
+                    self._post_conditions = [c1] + self._post_conditions
+                    post.add(c1)
         return True
         
     def addPreCondition(self, condition):
@@ -88,22 +88,22 @@ class ProcedureBase:
         self._post_conditions.append(condition)
         
     def getIsSpecifiedCond(self, clabel, subj, desired_state):
-        return cond.ConditionIsSpecified(clabel, subj, desired_state)
+        return cond.internCondition(cond.ConditionIsSpecified(clabel, subj, desired_state))
         
     def getGenerateCond(self, clabel, subj, desired_state):
-        return cond.ConditionGenerate(clabel, subj, desired_state)
+        return cond.internCondition(cond.ConditionGenerate(clabel, subj, desired_state))
         
     def getHasPropCond(self, clabel, olabel, subj, desired_state):
-        return cond.ConditionHasProperty(clabel, olabel, subj, desired_state)
+        return cond.internCondition(cond.ConditionHasProperty(clabel, olabel, subj, desired_state))
         
     def getPropCond(self, clabel, olabel, subj, value, desired_state):
-        return cond.ConditionProperty(clabel, olabel, subj, value, desired_state)
+        return cond.internCondition(cond.ConditionProperty(clabel, olabel, subj, value, desired_state))
         
     def getRelationCond(self, clabel, olabel, subj, obj, desired_state):
-        return cond.ConditionRelation(clabel, olabel, subj, obj, desired_state)
+        return cond.internCondition(cond.ConditionRelation(clabel, olabel, subj, obj, desired_state))
         
     def getOnTypeCond(self, clabel, subj, value):
-        return cond.ConditionOnType(clabel, subj, value)
+        return cond.internCondition(cond.ConditionOnType(clabel, subj, value))
         
     def getModifiedParams(self):
         param_list = set([])
@@ -165,6 +165,8 @@ class ProcedureInterface(ProcedureBase):
         self._pre_conditions=[]
         self._hold_conditions=[]
         self._post_conditions=[]
+        self._hold_records=[]
+        self._post_records=[]
         #Connections
         self._parent = None
         self._children=[] 
@@ -193,9 +195,13 @@ class ProcedureInterface(ProcedureBase):
         p._params = deepcopy(self._params)
         p._remaps = deepcopy(self._remaps)
         p._description = deepcopy(self._description)
-        p._pre_conditions = deepcopy(self._pre_conditions)
-        p._hold_conditions = deepcopy(self._hold_conditions)
-        p._post_conditions = deepcopy(self._post_conditions)
+        p._pre_conditions = list(self._pre_conditions)
+        p._hold_conditions = list(self._hold_conditions)
+        p._post_conditions = list(self._post_conditions)
+        #The undo records, so that a simulation can be reverted through the copy
+        p._hold_records = list(self._hold_records)
+        p._post_records = list(self._post_records)
+        p._was_simulated = self._was_simulated
         if self._state!=State.Uninitialized:
             p._state = copy(self._state)
             p._wm = self._wm            
@@ -257,12 +263,9 @@ class ProcedureInterface(ProcedureBase):
             c.remap(initial_key, target_key)
         #Remaps
         self._params.remap(initial_key, target_key)
-        for c in self._pre_conditions:
-            c.remap(initial_key, target_key)
-        for c in self._hold_conditions:
-            c.remap(initial_key, target_key)
-        for c in self._post_conditions:
-            c.remap(initial_key, target_key)
+        self._pre_conditions = [c.remap(initial_key, target_key) for c in self._pre_conditions]
+        self._hold_conditions = [c.remap(initial_key, target_key) for c in self._hold_conditions]
+        self._post_conditions = [c.remap(initial_key, target_key) for c in self._post_conditions]
         #Records
         if record:
             self._remaps[initial_key] = target_key
@@ -302,39 +305,61 @@ class ProcedureInterface(ProcedureBase):
                 return True
         return False
             
+    def _setConditions(self, conditions, records):
+        """
+        Set the conditions true, storing their undo records. Return the condition that failed, if any
+        """
+        del records[:]
+        for c in conditions:
+            record = c.setTrue(self._params, self._wm)
+            if record is None:
+                return c
+            records.append(record)
+        return None
+        
+    def _revertConditions(self, conditions, records):
+        """
+        Undo the conditions set with _setConditions, in reverse order. Return the condition that can't be reverted, if any
+        """
+        if len(records)<len(conditions):
+            return conditions[-1]
+        for c, record in reversed(zip(conditions, records)):
+            c.revert(self._params, self._wm, record)
+        del records[:]
+        return None
+        
     def hold(self):
-        for c in self._hold_conditions:
-            if not c.setTrue(self._params, self._wm):
-                log.error(c.getDescription(), "Hold failed.")
-                return False
+        c = self._setConditions(self._hold_conditions, self._hold_records)
+        if c:
+            log.error(c.getDescription(), "Hold failed.")
+            return False
         return True
         
     def revertHold(self):
-        for c in reversed(self._hold_conditions):
-            #print c.getDescription()
-            if not c.revert(self._params, self._wm):
-                log.error(c.getDescription(), "Revert hold failed.")
-                return False
+        c = self._revertConditions(self._hold_conditions, self._hold_records)
+        if c:
+            log.error(c.getDescription(), "Revert hold failed.")
+            return False
         self._was_simulated = False
         return True
         
     def simulate(self):
         self._was_simulated = True
         #print "Simulate: {}".format(self.printInfo(True))
-        for c in self._post_conditions:
-            if not c.setTrue(self._params, self._wm):
-                log.error(c.getDescription(), "Simulation failed.")
-                return False
+        c = self._setConditions(self._post_conditions, self._post_records)
+        if c:
+            log.error(c.getDescription(), "Simulation failed.")
+            return False
         return True
             
     def revertSimulation(self):
         if not self._was_simulated:
             log.warn("revert", "No simulation was made, can't revert.")
             return False
-        for c in reversed(self._post_conditions):
-            if not c.revert(self._params, self._wm):
-                log.error(c.getDescription(), "Revert failed.")
-                return False
+        c = self._revertConditions(self._post_conditions, self._post_records)
+        if c:
+            log.error(c.getDescription(), "Revert failed.")
+            return False
         self._was_simulated = False
         return True
         
@@ -467,7 +492,7 @@ class ProcedureInterface(ProcedureBase):
                 for key in c.getKeys():
                     if not p._params.hasParam(key):
                         p._params._params[key] = deepcopy(self._children[-2]._params._params[key])
-            p._pre_conditions += deepcopy(self._children[-2]._post_conditions)
+            p._pre_conditions += self._children[-2]._post_conditions
         return self
         
     def last(self):
@@ -546,13 +571,19 @@ class ProcedureInterface(ProcedureBase):
         Check pre-conditions. Return a list of parameters that breaks the conditions, or an empty list if all are satisfied
         """
         to_ret = Set()
-        for c in self._pre_conditions:
-            if not c.evaluate(self._params, self._wm):
-                if verbose:
-                    log.error(c.getDescription(), "ConditionCheck failed")
-                for key in c.getKeys():
-                    to_ret.add(key)
+        for i in cond.getPlan(self._pre_conditions).getFailed(self._params, self._wm):
+            c = self._pre_conditions[i]
+            if verbose:
+                log.error(c.getDescription(), "ConditionCheck failed")
+            for key in c.getKeys():
+                to_ret.add(key)
         return list(to_ret)
+        
+    def preCondHold(self):
+        """
+        Return true if all the pre-conditions are satisfied. Faster than checkPreCond, it stops at the first failure
+        """
+        return cond.getPlan(self._pre_conditions).holds(self._params, self._wm)
          
     def hasPostCond(self):
         if self._post_conditions:
@@ -565,12 +596,18 @@ class ProcedureInterface(ProcedureBase):
         Check post-conditions. Return a list of parameters that breaks the conditions, or an empty list if all are satisfied
         """
         to_ret = []
-        for c in self._post_conditions:
-            if not c.evaluate(self._params, self._wm):
-                if verbose:
-                    log.error(c.getDescription(), "ConditionCheck failed")
-                to_ret += c.getKeys()
+        for i in cond.getPlan(self._post_conditions).getFailed(self._params, self._wm):
+            c = self._post_conditions[i]
+            if verbose:
+                log.error(c.getDescription(), "ConditionCheck failed")
+            to_ret += c.getKeys()
         return to_ret
+        
+    def postCondHold(self):
+        """
+        Return true if all the post-conditions are satisfied. Faster than checkPostCond, it stops at the first failure
+        """
+        return cond.getPlan(self._post_conditions).holds(self._params, self._wm)
                 
     #--------User functions--------
     def setChildrenProcessor(self, processor):
@@ -589,37 +626,43 @@ class ProcedureInterface(ProcedureBase):
             self._params.reset(self._description._params.merge(other._params))
         else:
             self._params = deepcopy(self._description._params)
-        self._pre_conditions = deepcopy(self._description._pre_conditions)
-        self._hold_conditions = deepcopy(self._description._hold_conditions)
-        self._post_conditions = deepcopy(self._description._post_conditions)
+        self._pre_conditions = list(self._description._pre_conditions)
+        self._hold_conditions = list(self._description._hold_conditions)
+        self._post_conditions = list(self._description._post_conditions)
         self._children = []
         
     def mergeDescription(self, other):
         self.resetDescription(other)
+        pre = set(self._pre_conditions)
         for c in other._pre_conditions:
-            if not c in self._pre_conditions:
+            if not c in pre:
                 self.addPreCondition(c)
+                pre.add(self._pre_conditions[-1])
+        hold = set(self._hold_conditions)
         for c in other._hold_conditions:
-            if not c in self._hold_conditions:
+            if not c in hold:
                 self.addHoldCondition(c)
+                hold.add(self._hold_conditions[-1])
+        post = set(self._post_conditions)
         for c in other._post_conditions:
-            if not c in self._post_conditions:
-                self.addPostCondition(c)                
+            if not c in post:
+                self.addPostCondition(c)
+                post.add(self._post_conditions[-1])
                        
     def addPreCondition(self, condition):
-        self._pre_conditions.append(condition)
         for r1, r2 in self._remaps.iteritems():
-            self._pre_conditions[-1].remap(r1, r2)
+            condition = condition.remap(r1, r2)
+        self._pre_conditions.append(condition)
         
     def addHoldCondition(self, condition):
-        self._hold_conditions.append(condition)
         for r1, r2 in self._remaps.iteritems():
-            self._hold_conditions[-1].remap(r1, r2)
+            condition = condition.remap(r1, r2)
+        self._hold_conditions.append(condition)
             
     def addPostCondition(self, condition):
-        self._post_conditions.append(condition)
         for r1, r2 in self._remaps.iteritems():
-            self._post_conditions[-1].remap(r1, r2)  
+            condition = condition.remap(r1, r2)
+        self._post_conditions.append(condition)  
         
     def processChildren(self, visitor):
         """
@@ -660,9 +703,13 @@ class ProcedureInstance(ProcedureInterface, object):
         p._params = deepcopy(self._params)
         p._remaps = deepcopy(self._remaps)
         p._description = deepcopy(self._description)
-        p._pre_conditions = deepcopy(self._pre_conditions)
-        p._hold_conditions = deepcopy(self._hold_conditions)
-        p._post_conditions = deepcopy(self._post_conditions)
+        p._pre_conditions = list(self._pre_conditions)
+        p._hold_conditions = list(self._hold_conditions)
+        p._post_conditions = list(self._post_conditions)
+        #The undo records, so that a simulation can be reverted through the copy
+        p._hold_records = list(self._hold_records)
+        p._post_records = list(self._post_records)
+        p._was_simulated = self._was_simulated
         if self._state!=State.Uninitialized:
             p._state = self._state
             p._wm = self._wm       
@@ -801,7 +848,10 @@ class ProcedureWrapper(ProcedureInterface):
         self._pre_conditions=[]
         self._hold_conditions=[]
         self._post_conditions=[]
+        self._hold_records=[]
+        self._post_records=[]
         #Execution
+        self._was_simulated = False
         self._preempt_request = CEvent()
         self._state=State.Uninitialized
         self._state_change = CEvent()
@@ -823,9 +873,13 @@ class ProcedureWrapper(ProcedureInterface):
         p._params = deepcopy(self._params)
         p._remaps = deepcopy(self._remaps)
         p._description = deepcopy(self._description)
-        p._pre_conditions = deepcopy(self._pre_conditions)
-        p._hold_conditions = deepcopy(self._hold_conditions)
-        p._post_conditions = deepcopy(self._post_conditions)
+        p._pre_conditions = list(self._pre_conditions)
+        p._hold_conditions = list(self._hold_conditions)
+        p._post_conditions = list(self._post_conditions)
+        #The undo records, so that a simulation can be reverted through the copy
+        p._hold_records = list(self._hold_records)
+        p._post_records = list(self._post_records)
+        p._was_simulated = self._was_simulated
         if self._has_instance:
             p._has_instance=self._has_instance
             p._instance=self._instance
@@ -897,7 +951,10 @@ class Root(ProcedureInterface):
         self._pre_conditions=[]
         self._hold_conditions=[]
         self._post_conditions=[]
+        self._hold_records=[]
+        self._post_records=[]
         #Execution
+        self._was_simulated = False
         self._preempt_request = CEvent()
         self._state=State.Uninitialized
         self._state_change = CEvent()
@@ -936,7 +993,10 @@ class Procedure(ProcedureInterface):
         self._pre_conditions=[]
         self._hold_conditions=[]
         self._post_conditions=[]
+        self._hold_records=[]
+        self._post_records=[]
         #Execution
+        self._was_simulated = False
         self._preempt_request = CEvent()
         self._state=State.Uninitialized
         self._state_change = CEvent()
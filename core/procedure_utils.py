@@ -1,7 +1,6 @@
 from procedure import *
 import logger.logger as log
 from sets import Set
-import numpy as np
 
 class NodePrinter():
     def __init__(self):
@@ -106,7 +105,7 @@ class NodeExecutor():
                     else:
                         pass#log.info("Not instance", "{} Model: {} Match: {}".format(key, cp.getParamValue(key).printState(True), p.getValue().printState(True)))
                         
-        l = np.zeros(len(to_resolve), dtype=int)
+        l = [0]*len(to_resolve)
         unvalid_params = to_resolve
         loop = True
         while loop:
@@ -141,27 +140,33 @@ class NodeExecutor():
         """
         Ground undefined parameters with elements in the world model
         """       
-        matches = self._wm.resolveElements(to_resolve, cp)
+        #Only the first consistent binding is needed, stop there
+        failure = []
+        match = next(self._wm.iterGroundings(to_resolve, cp, failure), None)
+        if match is None:
+            entry = failure[0]
+            if isinstance(entry, tuple):
+                log.error("autoParametrizeWm", "Can't autoparametrize params {} (linked by relations).".format(" ".join(entry)))
+            else:
+                log.error("autoParametrizeWm", "Can't autoparametrize param {}.".format(entry))
+            return False
         grounded = ''
-        for key, match in matches.iteritems():
-            if match.any():
-                if isinstance(key, tuple):
-                    for i, key2 in enumerate(key):
-                        procedure._params.specify(key2, match[0][i]) 
-                        grounded += '[{}={}]'.format(key2, match[0][i].printState())
-                else:
-                    procedure._params.specify(key, match[0])
-                    grounded += '[{}={}]'.format(key, match[0].printState())
-            else: 
-                #print '{}: {}'.format(procedure._label, to_resolve)
-                log.error("autoParametrizeWm", "Can t autoparametrize param {}.".format(key))
-                return False
+        for key, value in match.iteritems():
+            if isinstance(key, tuple):
+                for i, key2 in enumerate(key):
+                    procedure._params.specify(key2, value[i]) 
+                    grounded += '[{}={}]'.format(key2, value[i].printState())
+            else:
+                procedure._params.specify(key, value)
+                grounded += '[{}={}]'.format(key, value.printState())
         log.info("MatchWm", "{} {}".format(procedure._label, grounded))
         return True
     
     def init(self, procedure):
         if not procedure.hasInstance():
             self._instanciator.assignInstance(procedure)
+        #Conditions are applied on the world model of the visitor, that can be a fork
+        procedure._wm = self._wm
             
     def ground(self, procedure):
         self.autoParametrizeBB(procedure)
@@ -180,6 +185,7 @@ class NodeExecutor():
                 used.append(i._label)
                 procedure._label = i._label
                 procedure.setInstance(i)
+                procedure._wm = self._wm
                 if self.ground(procedure):
                     return True
         return False
@@ -309,6 +315,7 @@ class TreeBuilder:
                         self._forget_branch.append(p)                 
         
     def addExecutionNode(self, procedure):
+        #The copy is taken before hold(): revert and postRevert must go through the original procedure
         p = procedure.getLightCopy()
         p._children = []
         parent = self.getExecutionParent()
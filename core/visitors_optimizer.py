@@ -36,12 +36,12 @@ class VisitorOptimizer(VisitorInterface, NodePrinter, NodeReversibleSimulator):
         #Rule 2: can-t go before a procedure with conflicting conditions
         for c1 in p1._post_conditions:
             for c2 in p2._post_conditions:
-                if c1.hasConflict(c2):
+                if c1.hasConflict(c2, p1._params, p2._params):
                     log.warn("RULE2.1", "{}:{} has conflict with {}:{}".format(p1._label, c1.getDescription(), p2._label, c2.getDescription()))
                     return False
         for c1 in p1._post_conditions:
             for c2 in p2._pre_conditions:
-                if c1.hasConflict(c2):
+                if c1.hasConflict(c2, p1._params, p2._params):
                     log.warn("RULE2.2", "{}:{} has conflict with {}:{}".format(p1._label, c1.getDescription(), p2._label, c2.getDescription()))
                     return False
         #Heuristic 1: no need to go before another equal procedure
@@ -58,7 +58,7 @@ class VisitorOptimizer(VisitorInterface, NodePrinter, NodeReversibleSimulator):
             Rule 3: parent preconditions involving params of child have to hold
         """
         #Rule 1: preconditions have to hold
-        if p1.checkPreCond(self._verbose):
+        if not p1.preCondHold():
             log.warn("RULE1", "{} preCondCheck failed.".format(p1._label))
             p1.checkPreCond(True)
             return False
@@ -70,16 +70,14 @@ class VisitorOptimizer(VisitorInterface, NodePrinter, NodeReversibleSimulator):
         #Rule 3: node moving out of its parent: preconditions involving params of child have to hold as well
         if p1.inSubtreeOf(p2):
             s = p1._label + ' is child of ' + p2._label + '. Adding conditions: '
+            pre = set(p1._pre_conditions)
             for c2 in p2._pre_conditions:
-                if [key for key, _ in p1._params.getParamMap().iteritems() if key in c2.getKeys()]:
-                    dont_add = False
-                    for c1 in p1._pre_conditions:
-                        if c1.isEqual(c2):
-                            dont_add = True
-                    if dont_add: continue
+                if [key for key in c2.getKeys() if p1._params.hasParam(key)]:
+                    if c2 in pre: continue
                     s += c2.getDescription()
                     s += ", "
                     p1.addPreCondition(c2)
+                    pre.add(p1._pre_conditions[-1])
                     for key in c2.getKeys():
                         if not p1._params.hasParam(key):
                             p1._params.getParamMap()[key] = p2._params.getParamMap()[key]
@@ -137,7 +135,7 @@ class VisitorOptimizer(VisitorInterface, NodePrinter, NodeReversibleSimulator):
             print self.printParams(procedure._params)
             return False
         #discard redundant
-        if not procedure.checkPostCond() and procedure.hasPostCond():
+        if procedure.hasPostCond() and procedure.postCondHold():
             log.info('discarded','Redundand procedure {}'.format(procedure._label))
             return True
         processor=None
@@ -210,7 +208,7 @@ class VisitorOptimizer(VisitorInterface, NodePrinter, NodeReversibleSimulator):
         return self._processor.processChildren(procedure._children, self)
         
     def postProcessNode(self, procedure):
-        if not procedure.checkPostCond() and procedure.hasPostCond():
+        if procedure.hasPostCond() and procedure.postCondHold():
             log.info('discarded','Redundand procedure {}'.format(procedure._label))
             return True            
         while not self.checkRule4(procedure):
@@ -1,18 +1,27 @@
 
 import logger.logger as log
 import params
-import semanticnet as sn
-import networkx as nx
-import matplotlib.pyplot as plt
 #from owlready import * #WORKS ONLY WITH Python 3.0... azz
 from itertools import chain
+from collections import OrderedDict
 from copy import deepcopy
-import rdflib
-from rdflib.namespace import RDF, RDFS, OWL, XSD, Namespace
-import numpy as np
+import os
+import math
+import hashlib
+import tempfile
+import cPickle as pickle
+from StringIO import StringIO
+import threading
+from functools import wraps
+from persistent import PMap, PSet
+
+class Namespace(unicode):
+    """
+    A namespace URI: namespace[name] is the URI of name, as with rdflib.Namespace, without importing rdflib
+    """
+    def __getitem__(self, name):
+        return self + name
 
-ontology=rdflib.Graph()
-ontology.load('data/base_ontology.owl')
 PREFIX="""
 PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -20,24 +29,173 @@ PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 PREFIX owl: <http://www.w3.org/2002/07/owl#>
 PREFIX stmn: <http://www.semanticweb.org/francesco/ontologies/2014/9/stamina#>
 """
-STMN = Namespace('http://www.semanticweb.org/francesco/ontologies/2014/9/stamina#')
+STMN = Namespace(u'http://www.semanticweb.org/francesco/ontologies/2014/9/stamina#')
+
+_ontology_files=[os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'base_ontology.owl')]
+_ontology=None
+_ontology_modified=False
+_cache_version=1
+_hierarchies={}
+_namespaces={}
+_subtypes={}
+
+def getOntology():
+    """
+    Return the ontology graph. The OWL files are parsed on first use only
+    """
+    global _ontology
+    if _ontology is None:
+        import rdflib
+        _ontology = rdflib.Graph()
+        for filename in _ontology_files:
+            _ontology.load(filename)
+    return _ontology
+
+def _buildHierarchy(predicate):
+    """
+    Return the direct and the transitive closure of an ontology hierarchy (subClassOf or subPropertyOf)
+    as two maps from a parent to the set of its children
+    """
+    from rdflib.namespace import RDFS
+    direct = {}
+    for child, parent in getOntology().subject_objects(RDFS[predicate]):
+        direct.setdefault(unicode(parent), set()).add(unicode(child))
+    closure = {}
+    def visit(node, visiting):
+        if node in closure:
+            return closure[node]
+        visiting.add(node)
+        to_ret = set()
+        for c in direct.get(node, ()):
+            to_ret.add(c)
+            if not c in visiting:
+                to_ret |= visit(c, visiting)
+        visiting.discard(node)
+        closure[node] = frozenset(to_ret)
+        return closure[node]
+    for node in direct.keys():
+        visit(node, set())
+    return direct, closure
+
+def _hashOntology():
+    h = hashlib.sha1(str(_cache_version))
+    for filename in _ontology_files:
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _loadHierarchies():
+    """
+    Load the hierarchies and namespaces from the cache file next to the ontology, or compile them if the
+    OWL files changed. The cache is skipped when the ontology graph was modified in memory
+    """
+    cache = os.path.splitext(_ontology_files[0])[0] + ".cache"
+    if not _ontology_modified:
+        digest = _hashOntology()
+        try:
+            with open(cache, 'rb') as f:
+                data = pickle.load(f)
+            if data["hash"]==digest:
+                _hierarchies.update(data["hierarchies"])
+                _namespaces.update(data["namespaces"])
+                return
+        except Exception:
+            #A missing, truncated or incompatible cache is a miss
+            pass
+    for predicate in ("subClassOf", "subPropertyOf"):
+        _hierarchies[predicate] = _buildHierarchy(predicate)
+    for prefix, uri in getOntology().namespaces():
+        _namespaces[unicode(prefix)] = unicode(uri)
+    if not _ontology_modified:
+        #Write a temporary file and rename it over the cache, so readers never see a partial cache
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(cache)))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({"hash": digest, "hierarchies": _hierarchies, "namespaces": _namespaces}, f, pickle.HIGHEST_PROTOCOL)
+            #mkstemp creates the file private to the user, give it the usual permissions
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0666 & ~umask)
+            os.rename(tmp, cache)
+        except Exception:
+            log.warn("ontology", "Can't write the ontology cache {}.".format(cache))
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+def _getHierarchy(predicate):
+    if not _hierarchies:
+        _loadHierarchies()
+    return _hierarchies[predicate]
+
+def getNamespaces():
+    """
+    Return the namespaces declared in the ontology, as a map from prefix to URI
+    """
+    if not _hierarchies:
+        _loadHierarchies()
+    return dict(_namespaces)
+
+def _clearHierarchies():
+    _hierarchies.clear()
+    _namespaces.clear()
+    _subtypes.clear()
+
+def invalidateOntologyCache():
+    """
+    Drop the precomputed hierarchies. Must be called after modifying the ontology graph
+    """
+    global _ontology_modified
+    _ontology_modified = True
+    _clearHierarchies()
+
+def loadOntology(filename):
+    _ontology_files.append(filename)
+    if _ontology is not None:
+        _ontology.load(filename)
+    _clearHierarchies()
 
 def getSubClasses(name, recursive=False):
-    to_ret = list(ontology.subjects(RDFS["subClassOf"], rdflib.URIRef(name)))
+    direct, closure = _getHierarchy("subClassOf")
     if recursive:
-        for c in to_ret:
-            to_ret += getSubClasses(c, recursive)
-    return to_ret
+        return list(closure.get(unicode(name), ()))
+    return list(direct.get(unicode(name), ()))
     
 def getSubProperties(name, recursive=False):
-    to_ret = list(ontology.subjects(RDFS["subPropertyOf"], rdflib.URIRef(name)))
+    direct, closure = _getHierarchy("subPropertyOf")
     if recursive:
-        for c in to_ret:
-            to_ret += getSubProperties(c, recursive)
-    return to_ret
+        return list(closure.get(unicode(name), ()))
+    return list(direct.get(unicode(name), ()))
+
+def isSubClass(name, parent):
+    """
+    Return true if name is a (direct or indirect) subclass of parent
+    """
+    return unicode(name) in _getHierarchy("subClassOf")[1].get(unicode(parent), ())
+
+def getSubTypes(etype):
+    """
+    Return the set of type names matching etype (etype and all its subclasses)
+    """
+    if not etype in _subtypes:
+        types = set([etype])
+        for c in getSubClasses(STMN[etype], True):
+            if c.startswith(STMN):
+                types.add(c[len(STMN):])
+        _subtypes[etype] = frozenset(types)
+    return _subtypes[etype]
+
+def isSubProperty(name, parent):
+    """
+    Return true if name is a (direct or indirect) subproperty of parent
+    """
+    return unicode(name) in _getHierarchy("subPropertyOf")[1].get(unicode(parent), ())
     
 class Element(object):
     """
+    Elements returned by the world model are read-only views on the graph storage: the property map
+    is shared and gets copied only when the element is modified (copy-on-write). A modification copies
+    only the property it writes, the other properties stay shared.
     """     
     def printState(self, verbose=False):
         to_ret = self._type + "-" + str(self._id) + ":" + self._label #+ self._properties
@@ -55,10 +213,36 @@ class Element(object):
         self._id=eid      
         self._properties={}  
         self._relations=[] 
+        self._shared=False
+        self._owned=None
         
     def __str__(self):
         return self.printState()
         
+    def __deepcopy__(self, memo):
+        """
+        The copy shares the property map with the original, until one of the two is modified
+        """
+        result = Element(self._type, self._label, self._id)
+        result._properties = self._properties
+        result._relations = [dict(r) for r in self._relations]
+        result._shared = True
+        self._shared = True
+        memo[id(self)] = result
+        return result
+        
+    def _detach(self, key=None):
+        """
+        Take a private copy of the property map, if shared, and of the property at key
+        """
+        if self._shared:
+            self._properties = dict(self._properties)
+            self._shared = False
+            self._owned = set()
+        if key is not None and self._owned is not None and not key in self._owned:
+            self._properties[key] = deepcopy(self._properties[key])
+            self._owned.add(key)
+        
     def addRelation(self, subj_id, predicate, obj_id, state=True):
         self._relations.append({'src': subj_id, 'type': predicate, 'dst': obj_id, 'state': state})
         
@@ -66,13 +250,18 @@ class Element(object):
         return self._properties.has_key(key)        
         
     def addProperty(self, key, value):
+        self._detach()
         self._properties[key] = params.Param(key, "", value, params.ParamTypes.Discrete)
+        if self._owned is not None:
+            self._owned.add(key)
                     
     def removeProperty(self, key):
+        self._detach()
         del self._properties[key]
         
     def appendProperty(self, key, value):
         if self.hasProperty(key):
+            self._detach(key)
             self._properties[key].append(value)
         else:
             self.addProperty(key, value)
@@ -83,10 +272,12 @@ class Element(object):
         return False
         
     def getProperty(self, key):
+        self._detach(key)
         return self._properties[key]
         
     def removePropertyValue(self, key, value):
         if self.hasProperty(key):
+            self._detach(key)
             index = self._properties[key].find(value)
             self._properties[key].remove(index)
         else:
@@ -94,6 +285,7 @@ class Element(object):
             
     def setPropertyValues(self, key, value):
         if self.hasProperty(key):
+            self._detach(key)
             self._properties[key].setValues(value)
         else:
             log.warn("setPropertyValues", 'Property {} is not in the map.'.format(key))
@@ -108,7 +300,7 @@ class Element(object):
         Return true if this is a valid instance, false otherwise
         """
         #Filter by type
-        if not self._type==abstract._type and not (STMN[self._type] in getSubClasses(STMN[abstract._type], True)):
+        if not self._type==abstract._type and not isSubClass(STMN[self._type], STMN[abstract._type]):
             return False
         #Filter by label
         if not (abstract._label=="" or abstract._label=="Unknown" or self._label==abstract._label):
@@ -148,6 +340,13 @@ class DiscreteReasoner(object):
     def computeRelations(self, sub, obj):
         """ Not implemented in abstract class. """
         raise NotImplementedError("Not implemented in abstract class")
+        
+    def queryRelated(self, wmi, sub, relation):
+        """ 
+            Optional, return the ids of the objects related to sub, or None if unsupported.
+            Lets the world model answer a relation constraint without testing every pair.
+        """
+        return None
 
 class SpatialReasoner(DiscreteReasoner):
     def getAssociatedRelations(self):
@@ -163,62 +362,947 @@ class SpatialReasoner(DiscreteReasoner):
         to_ret.append(edge)
         return to_ret
 
-class WorldModel:
-    _id=0
-    _graph=sn.Graph()
+class ProximityReasoner(DiscreteReasoner):
+    """
+    Relates the elements whose Position is closer than a distance
+    """
+    distance = 1.0
+    
+    def getAssociatedRelations(self):
+        return ['near']
+        
+    def getAssociatedProperties(self):
+        return ['Position']
+    
+    def computeRelations(self, sub, obj):
+        p1 = SpatialIndex.getPoint(sub._properties)
+        p2 = SpatialIndex.getPoint(obj._properties)
+        if sub._id==obj._id or p1 is None or p2 is None or len(p1)!=len(p2):
+            return []
+        if SpatialIndex.distance(p1, p2)>self.distance:
+            return []
+        return [{'src': sub._id, 'dst': obj._id, 'type': 'near'}]
+        
+    def queryRelated(self, wmi, sub, relation):
+        return set(e._id for e in wmi.getNearby(sub._id, self.distance))
+
+_reasoners={}
+
+def registerReasoners():
+    """
+    Build the registry of the reasoners from the subclasses of DiscreteReasoner. It is built on the first query:
+    call it again after defining a new reasoner
+    """
+    _reasoners.clear()
+    for cls in reversed(DiscreteReasoner.__subclasses__()):
+        instance = cls()
+        for r in instance.getAssociatedRelations():
+            _reasoners[r] = instance
+
+def getReasoner(relation):
+    """
+    Return the reasoner computing a relation, or None
+    """
+    if not _reasoners:
+        registerReasoners()
+    return _reasoners.get(relation)
+
+class RelationIndex(object):
+    """
+    Index of the world model edges by subject, by object and by predicate
+
+    Lookups with a concrete subject and/or object cost O(result) instead of O(|E|)
+    """
+    def __init__(self):
+        self._edges=PMap()
+        self._by_src=PMap()
+        self._by_dst=PMap()
+        self._by_type=PMap()
+
+    def fork(self):
+        to_ret = RelationIndex()
+        to_ret._edges = self._edges.fork()
+        to_ret._by_src = self._by_src.fork()
+        to_ret._by_dst = self._by_dst.fork()
+        to_ret._by_type = self._by_type.fork()
+        return to_ret
+
+    def _insert(self, index, key, rtype, eid):
+        index.mutable(key, PMap).mutable(rtype, PSet).add(eid)
 
+    def _erase(self, index, key, rtype, eid):
+        types = index.mutable(key, PMap)
+        eids = types.mutable(rtype, PSet)
+        eids.discard(eid)
+        if not eids:
+            del types[rtype]
+            if not types:
+                del index[key]
+
+    def add(self, eid, src, rtype, dst):
+        self._edges[eid] = (src, rtype, dst)
+        self._insert(self._by_src, src, rtype, eid)
+        self._insert(self._by_dst, dst, rtype, eid)
+        self._by_type.mutable(rtype, PSet).add(eid)
+
+    def remove(self, eid):
+        src, rtype, dst = self._edges.pop(eid)
+        self._erase(self._by_src, src, rtype, eid)
+        self._erase(self._by_dst, dst, rtype, eid)
+        eids = self._by_type.mutable(rtype, PSet)
+        eids.discard(eid)
+        if not eids:
+            del self._by_type[rtype]
+
+    def has(self, eid):
+        return eid in self._edges
+
+    def get(self, eid):
+        """
+        Return the edge as a (src, type, dst) tuple
+        """
+        return self._edges[eid]
+
+    def getIncident(self, nid):
+        """
+        Return the ids of all edges entering or leaving a node
+        """
+        to_ret = set()
+        for index in (self._by_src, self._by_dst):
+            for eids in index.get(nid, {}).itervalues():
+                to_ret.update(eids)
+        return to_ret
+
+    def _select(self, types, rtypes):
+        if rtypes is None:
+            for eids in types.itervalues():
+                for eid in eids:
+                    yield eid
+        else:
+            for t in rtypes:
+                for eid in types.get(t, ()):
+                    yield eid
+
+    def find(self, src, rtypes, dst):
+        """
+        Return the ids of the edges matching subject, predicate and object
+
+        src, dst: node ids, a negative value matches any node
+        rtypes: a set of predicates, None matches any predicate
+        """
+        if src>=0 and dst>=0:
+            #Scan the smallest of the two adjacency lists
+            by_src = self._by_src.get(src, {})
+            by_dst = self._by_dst.get(dst, {})
+            if sum(len(s) for s in by_src.itervalues()) <= sum(len(s) for s in by_dst.itervalues()):
+                return [eid for eid in self._select(by_src, rtypes) if self._edges[eid][2]==dst]
+            else:
+                return [eid for eid in self._select(by_dst, rtypes) if self._edges[eid][0]==src]
+        elif src>=0:
+            return list(self._select(self._by_src.get(src, {}), rtypes))
+        elif dst>=0:
+            return list(self._select(self._by_dst.get(dst, {}), rtypes))
+        elif rtypes is not None:
+            return list(self._select(self._by_type, rtypes))
+        else:
+            return self._edges.keys()
+
+class AdjacencyMatrices(object):
+    """
+    Sparse boolean adjacency matrices over the element ids, one per set of predicates, built from a RelationIndex
+    
+    Matrices are built on demand. An edge change doesn't drop them: the (subject, object) pair is staged, and
+    queries read the staged pairs from the RelationIndex. A matrix is rebuilt only when more than _max_pending
+    pairs are staged on it. Requires scipy
+    """
+    _max_pending = 256
+    
+    def __init__(self):
+        import numpy
+        import scipy.sparse
+        self._np = numpy
+        self._sparse = scipy.sparse
+        self._matrices = {}
+        self._pending = {}
+        
+    def invalidate(self):
+        if self._matrices:
+            self._matrices = {}
+            self._pending = {}
+            
+    def update(self, esubject, relation, eobject):
+        """
+        Stage the change of an edge in the matrices of its predicate
+        """
+        for key, pending in self._pending.iteritems():
+            if key is None or relation in key:
+                pending.add((esubject, eobject))
+        
+    def get(self, relations, rtypes, size):
+        """
+        Return the adjacency matrix (CSR) of the predicates in rtypes, with at least size rows and columns, and
+        the pairs changed since it was built
+        """
+        key = frozenset(rtypes) if rtypes is not None else None
+        matrix = self._matrices.get(key)
+        pending = self._pending.get(key)
+        if matrix is None or matrix.shape[0]<size or len(pending)>self._max_pending:
+            edges = [relations.get(eid) for eid in relations.find(-1, rtypes, -1)]
+            src = self._np.array([e[0] for e in edges], dtype=int)
+            dst = self._np.array([e[2] for e in edges], dtype=int)
+            size = max([size] + [max(e[0], e[2])+1 for e in edges])
+            matrix = self._sparse.csr_matrix((self._np.ones(len(edges), dtype=bool), (src, dst)), shape=(size, size))
+            pending = set()
+            self._matrices[key] = matrix
+            self._pending[key] = pending
+        return matrix, pending
+        
+    def related(self, relations, rtypes, ids1, ids2):
+        """
+        Test all the pairs of ids1 x ids2 at once. Return a map from each id in ids1 to the set of related ids in ids2
+        """
+        size = max(max(ids1), max(ids2))+1
+        matrix, pending = self.get(relations, rtypes, size)
+        block = matrix[ids1][:, ids2]
+        targets = self._np.array(ids2)
+        indptr = block.indptr
+        indices = block.indices
+        to_ret = dict((i, set(targets[indices[indptr[r]:indptr[r+1]]].tolist())) for r, i in enumerate(ids1))
+        if pending:
+            targets = set(ids2)
+            for esubject, eobject in pending:
+                if esubject in to_ret and eobject in targets:
+                    if relations.find(esubject, rtypes, eobject):
+                        to_ret[esubject].add(eobject)
+                    else:
+                        to_ret[esubject].discard(eobject)
+        return to_ret
+
+class NodeIndex(object):
+    """
+    Index of the world model nodes by type and by label
+    """
+    def __init__(self):
+        self._keys=PMap()
+        self._by_type=PMap()
+        self._by_label=PMap()
+
+    def fork(self):
+        to_ret = NodeIndex()
+        to_ret._keys = self._keys.fork()
+        to_ret._by_type = self._by_type.fork()
+        to_ret._by_label = self._by_label.fork()
+        return to_ret
+
+    def _erase(self, index, key, nid):
+        nids = index.mutable(key, PSet)
+        nids.discard(nid)
+        if not nids:
+            del index[key]
+
+    def add(self, nid, etype, elabel):
+        if nid in self._keys:
+            if self._keys[nid]==(etype, elabel):
+                return
+            self.remove(nid)
+        self._keys[nid] = (etype, elabel)
+        self._by_type.mutable(etype, PSet).add(nid)
+        self._by_label.mutable(elabel, PSet).add(nid)
+
+    def remove(self, nid):
+        etype, elabel = self._keys.pop(nid)
+        self._erase(self._by_type, etype, nid)
+        self._erase(self._by_label, elabel, nid)
+
+    def find(self, types, elabel=None):
+        """
+        Return the sorted ids of the nodes with a type in types and, if specified, the given label
+        """
+        if elabel is not None:
+            to_ret = [nid for nid in self._by_label.get(elabel, ()) if self._keys[nid][0] in types]
+        else:
+            to_ret = []
+            for t in types:
+                to_ret.extend(self._by_type.get(t, ()))
+        to_ret.sort()
+        return to_ret
+
+class PropertyIndex(object):
+    """
+    Inverted index from (property key, value) to the ids of the nodes having that value
+    
+    Unhashable values are not indexed, only the presence of their key is
+    """
+    _reserved=("id", "type", "label")
+    
+    def __init__(self):
+        self._values=PMap()
+        self._by_key=PMap()
+        self._by_value=PMap()
+        
+    def fork(self):
+        to_ret = PropertyIndex()
+        to_ret._values = self._values.fork()
+        to_ret._by_key = self._by_key.fork()
+        to_ret._by_value = self._by_value.fork()
+        return to_ret
+        
+    def _erase(self, index, key, nid):
+        nids = index.mutable(key, PSet)
+        nids.discard(nid)
+        if not nids:
+            del index[key]
+        
+    def _hashable(self, values):
+        to_ret = set()
+        for v in values:
+            try:
+                hash(v)
+            except TypeError:
+                continue
+            to_ret.add(v)
+        return frozenset(to_ret)
+        
+    def update(self, nid, props):
+        """
+        Re-index a node, given the dictionary of its stored attributes
+        """
+        new = {}
+        for k, p in props.iteritems():
+            if not k in self._reserved:
+                new[k] = self._hashable(p.getValues())
+        old = self._values.get(nid, {})
+        for k, values in old.iteritems():
+            if not k in new:
+                self._erase(self._by_key, k, nid)
+                removed = values
+            else:
+                removed = values - new[k]
+            for v in removed:
+                self._erase(self._by_value, (k, v), nid)
+        for k, values in new.iteritems():
+            if not k in old:
+                self._by_key.mutable(k, PSet).add(nid)
+                added = values
+            else:
+                added = values - old[k]
+            for v in added:
+                self._by_value.mutable((k, v), PSet).add(nid)
+        self._values[nid] = new
+        
+    def remove(self, nid):
+        for k, values in self._values.pop(nid, {}).iteritems():
+            self._erase(self._by_key, k, nid)
+            for v in values:
+                self._erase(self._by_value, (k, v), nid)
+                
+    def find(self, key, value=None):
+        """
+        Return the ids of the nodes having the property key (with the given value, if specified).
+        Return None if the value can't be looked up in the index.
+        """
+        if value is None:
+            return self._by_key.get(key, set())
+        try:
+            return self._by_value.get((key, value), set())
+        except TypeError:
+            return None
+
+class RWLock(object):
+    """
+    A reader-writer lock. Many threads can read at the same time, writers are exclusive.
+
+    Both read and write sections are reentrant, and the writer can also read.
+    Waiting writers have priority on new readers, so they don't starve.
+    A read section can't be upgraded to a write section (RuntimeError).
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+
+    def acquireRead(self):
+        me = threading.current_thread().ident
+        with self._cond:
+            if self._writer!=me and not me in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def releaseRead(self):
+        me = threading.current_thread().ident
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquireWrite(self):
+        me = threading.current_thread().ident
+        with self._cond:
+            if self._writer==me:
+                self._writes += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("A read lock can't be upgraded to a write lock")
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._writes = 1
+
+    def releaseWrite(self):
+        with self._cond:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
+
+def _reader(method):
+    """
+    Run the method in a read section, if the world model is thread safe
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock = self._lock
+        if lock is None:
+            return method(self, *args, **kwargs)
+        lock.acquireRead()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.releaseRead()
+    return wrapper
+
+def _writer(method):
+    """
+    Run the method in a write section, if the world model is thread safe
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock = self._lock
+        if lock is None:
+            return method(self, *args, **kwargs)
+        lock.acquireWrite()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.releaseWrite()
+    return wrapper
+
+class Journal(list):
+    """
+    The undo records of a transaction
+
+    A nested transaction is committed into the outer journal as a single entry, so it is undone once whether it
+    is reverted on its own, with the outer journal, or both
+    """
+    def __init__(self):
+        list.__init__(self)
+        self.reverted = False
+        
+class ContainmentTree(object):
+    """
+    Index of the contain hierarchy: parent pointers and child sets
+    
+    Ancestor tests walk the parent pointers, in O(depth). When the tree stays unchanged for enough queries,
+    it gets interval labels (preorder number, last preorder number of the subtree), and the tests take O(1)
+    until the next change. Labelling costs O(N), so frequent changes (e.g. during a simulation) never pay it
+    """
+    def __init__(self):
+        self._parent=PMap()
+        self._children=PMap()
+        self._labels=None
+        self._queries=0
+        
+    def fork(self):
+        to_ret = ContainmentTree()
+        to_ret._parent = self._parent.fork()
+        to_ret._children = self._children.fork()
+        to_ret._labels = self._labels
+        to_ret._queries = self._queries
+        return to_ret
+        
+    def add(self, parent, child):
+        self._parent[child] = parent
+        self._children.mutable(parent, PSet).add(child)
+        self._labels = None
+        self._queries = 0
+        
+    def remove(self, parent, child):
+        if self._parent.get(child)==parent:
+            del self._parent[child]
+        children = self._children.mutable(parent, PSet)
+        children.discard(child)
+        if not children:
+            del self._children[parent]
+        self._labels = None
+        self._queries = 0
+        
+    def getParent(self, child):
+        return self._parent.get(child)
+        
+    def getChildren(self, parent):
+        return sorted(self._children.get(parent, ()))
+        
+    def _label(self):
+        labels = {}
+        counter = 0
+        for root in sorted(n for n in self._children.iterkeys() if not n in self._parent):
+            labels[root] = [counter, counter]
+            counter += 1
+            stack = [(root, iter(self.getChildren(root)))]
+            while stack:
+                node, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    labels[node][1] = counter-1
+                elif not child in labels:
+                    labels[child] = [counter, counter]
+                    counter += 1
+                    stack.append((child, iter(self.getChildren(child))))
+        return labels
+        
+    def _walk(self, ancestor, eid):
+        parent = self._parent.get(eid)
+        steps = len(self._parent)
+        while parent is not None and steps:
+            if parent==ancestor:
+                return True
+            parent = self._parent.get(parent)
+            steps -= 1
+        return False
+        
+    def isAncestor(self, ancestor, eid):
+        """
+        Return true if eid is contained, directly or indirectly, in ancestor
+        """
+        labels = self._labels
+        if labels is None:
+            #Label the tree once the queries since the last change would have cost about as much
+            self._queries += 1
+            if self._queries*16 < len(self._parent):
+                return self._walk(ancestor, eid)
+            labels = self._labels = self._label()
+        a = labels.get(ancestor)
+        b = labels.get(eid)
+        if a is None or b is None:
+            return False
+        return a[0]<b[0] and b[0]<=a[1]
+
+class SpatialIndex(object):
+    """
+    Uniform grid over the element positions (the values of the Position property)
+    
+    Range queries visit only the grid cells overlapping the range. Points of different dimensions are kept apart
+    """
+    def __init__(self, cell_size=1.0):
+        self._cell_size=cell_size
+        self._points=PMap()
+        self._cells=PMap()
+        
+    def fork(self):
+        to_ret = SpatialIndex(self._cell_size)
+        to_ret._points = self._points.fork()
+        to_ret._cells = self._cells.fork()
+        return to_ret
+        
+    @staticmethod
+    def getPoint(props):
+        """
+        Return the position stored in a property map as a tuple of floats, or None
+        """
+        p = props.get("Position")
+        if p is None:
+            return None
+        try:
+            point = tuple(float(v) for v in p.getValues())
+        except (TypeError, ValueError):
+            return None
+        return point if point else None
+        
+    @staticmethod
+    def distance(p1, p2):
+        return math.sqrt(sum((a-b)**2 for a, b in zip(p1, p2)))
+        
+    def _cell(self, point):
+        return tuple(int(math.floor(v/self._cell_size)) for v in point)
+        
+    def update(self, nid, props):
+        point = self.getPoint(props)
+        old = self._points.get(nid)
+        if point==old:
+            return
+        if old is not None:
+            self.remove(nid)
+        if point is not None:
+            self._points[nid] = point
+            self._cells.mutable(self._cell(point), PSet).add(nid)
+            
+    def remove(self, nid):
+        point = self._points.pop(nid, None)
+        if point is None:
+            return
+        cell = self._cell(point)
+        nids = self._cells.mutable(cell, PSet)
+        nids.discard(nid)
+        if not nids:
+            del self._cells[cell]
+            
+    def getPosition(self, nid):
+        return self._points.get(nid)
+        
+    def findInRange(self, center, radius):
+        """
+        Return the ids of the points closer than radius to center
+        """
+        low = self._cell([v-radius for v in center])
+        high = self._cell([v+radius for v in center])
+        cells = 1
+        for l, h in zip(low, high):
+            cells *= h-l+1
+        if cells>len(self._points):
+            #Scanning the points is cheaper than visiting the cells
+            candidates = self._points.iterkeys()
+        else:
+            candidates = []
+            for cell in self._iterCells(low, high):
+                candidates.extend(self._cells.get(cell, ()))
+        to_ret = []
+        for nid in candidates:
+            point = self._points[nid]
+            if len(point)==len(center) and self.distance(point, center)<=radius:
+                to_ret.append(nid)
+        return to_ret
+        
+    def _iterCells(self, low, high):
+        if not low:
+            yield ()
+            return
+        for rest in self._iterCells(low[1:], high[1:]):
+            for i in xrange(low[0], high[0]+1):
+                yield (i,) + rest
+
+class WorldModel:
+    """
+    A scene graph. Each instance owns its storage (nodes, edges, indexes and id allocator),
+    so many independent scenes can live in the same process. Only the ontology is shared.
+    """
+    #Relations computed by the reasoners kept in memory, the least recently used are dropped
+    _max_reasoned = 65536
+    
     def __init__(self, scene_name=None):
         self._verbose=False
+        self._lock=None
+        self._reasoned_mutex=threading.Lock()
+        self._next_id=0
+        self._free_ids=PSet()
+        self._free_stack=None
+        self._journals=[]
+        self._graph=PMap()
+        self._edge_id=0
+        self._relations=RelationIndex()
+        self._tree=ContainmentTree()
+        self._contain_types=None
+        self._matrices=None
+        self._reasoned=OrderedDict()
+        self._reasoned_keys={}
+        self._nodes=NodeIndex()
+        self._properties=PropertyIndex()
+        self._spatial=SpatialIndex()
         if scene_name:
             self.reset(scene_name)
     
     def __copy__(self):
+        """
+        The world model is shared by reference: copies of conditions and procedures keep working on
+        the same scene, id allocator and journal. Use fork() to get an independent branch.
+        """
+        return self
+        
+    @_writer
+    def fork(self):
+        """
+        Return an independent branch of the world model, in O(1)
+        
+        The branch shares the current scene with the original. Changes made on either side afterwards
+        are not visible to the other one.
+        """
         wm = WorldModel()
         wm._verbose=self._verbose
-        wm._id = self._id
-        wm._graph = self._graph
+        wm.setThreadSafe(self._lock is not None)
+        wm._next_id = self._next_id
+        wm._free_ids = self._free_ids.fork()
+        wm._free_stack = self._free_stack
+        wm._graph = self._graph.fork()
+        wm._edge_id = self._edge_id
+        wm._relations = self._relations.fork()
+        wm._tree = self._tree.fork()
+        wm.setSparseBackend(self._matrices is not None)
+        wm._nodes = self._nodes.fork()
+        wm._properties = self._properties.fork()
+        wm._spatial = self._spatial.fork()
         return wm
     
     def __deepcopy__(self, memo):
-        result = self.__copy__()
-        memo[id(self)] = result
-        return result
+        return self
+        
+    def setThreadSafe(self, value=True):
+        """
+        Protect the world model with a reader-writer lock, to share it between threads.
+        Queries run concurrently, while mutations and transactions are exclusive.
+        """
+        if not value:
+            self._lock = None
+        elif self._lock is None:
+            self._lock = RWLock()
+            
+    def isThreadSafe(self):
+        return self._lock is not None
+        
+    def setSparseBackend(self, value=True):
+        """
+        Test the relation constraints of resolveElements with sparse adjacency matrices, a candidate block at once.
+        Pays off on large scenes. Requires scipy, return False if not available
+        """
+        if not value:
+            self._matrices = None
+        elif self._matrices is None:
+            try:
+                self._matrices = AdjacencyMatrices()
+            except ImportError:
+                log.error("setSparseBackend", "scipy is required by the sparse backend.")
+                return False
+        return True
         
+    @_writer
     def generateId(self, desired_id):
-        if desired_id>=0:
-            self._id = desired_id
-        while self._graph.has_node(self._id):
-            self._id += 1
-        return self._id
+        """
+        Return a free id, in O(1): desired_id if it is free, otherwise the last released id or a new one
+        """
+        if desired_id>=0 and not desired_id in self._graph:
+            return desired_id
+        #The stack can hold ids claimed again after their release, skip them
+        while self._free_stack is not None:
+            eid, rest = self._free_stack
+            if eid in self._free_ids:
+                return eid
+            self._free_stack = rest
+        return self._next_id
+        
+    def _claimId(self, eid):
+        if eid>=self._next_id:
+            #The ids skipped are not on the free list: they are still free in the graph, for a desired id
+            self._next_id = eid + 1
+        else:
+            self._free_ids.discard(eid)
+            
+    def _releaseId(self, eid):
+        self._free_ids.add(eid)
+        self._free_stack = (eid, self._free_stack)
         
+    @_writer
     def reset(self, scene_name):
-        self._id=0
-        self._graph=sn.Graph()
+        self._next_id=0
+        self._free_ids=PSet()
+        self._free_stack=None
+        self._graph=PMap()
+        self._edge_id=0
+        self._relations=RelationIndex()
+        self._tree=ContainmentTree()
+        if self._matrices is not None:
+            self._matrices.invalidate()
+        self._reasoned=OrderedDict()
+        self._reasoned_keys={}
+        self._nodes=NodeIndex()
+        self._properties=PropertyIndex()
+        self._spatial=SpatialIndex(self._spatial._cell_size)
+        self._journals=[]
         root = Element("Scene", scene_name, 0)
         props = { "type" : root._type, "label" : root._label}
-        self._graph.add_node(dict(chain(props.items(),root._properties.items())), root._id)
-        
-    def _printRecursive(self, to_ret, root, indend):
-        s = root.printState()
-        to_ret = to_ret + indend + s + "\n"
-        indend = "-"*(len(indend)+len(s))+"->"
-        for e in self.getChildren(root._id):
-            to_ret = self._printRecursive(to_ret, e, indend)
-        return to_ret
+        self._addNode(root._id, dict(chain(props.items(),root._properties.items())))
         
+    def __enter__(self):
+        self.startTransaction()
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commitTransaction()
+        else:
+            self.rollbackTransaction()
+        return False
+        
+    def startTransaction(self):
+        """
+        Start recording the mutations in an undo journal. Transactions can be nested
+        
+        In thread safe mode a transaction is an exclusive write section, held until commit or rollback
+        """
+        if self._lock is not None:
+            self._lock.acquireWrite()
+        self._journals.append(Journal())
+        
+    def commitTransaction(self):
+        """
+        Close the current transaction and return its journal. A nested transaction is merged into the outer one
+        """
+        journal = self._journals.pop()
+        if self._journals:
+            self._journals[-1].append(("journal", journal))
+        if self._lock is not None:
+            self._lock.releaseWrite()
+        return journal
+        
+    def rollbackTransaction(self):
+        """
+        Close the current transaction and undo its mutations
+        """
+        journal = self._journals[-1]
+        #The undo of a rollback is not recorded: the mutations it reverts were never in the outer journal
+        self._journals[-1] = Journal()
+        try:
+            self.revertJournal(journal)
+        finally:
+            self._journals.pop()
+            if self._lock is not None:
+                self._lock.releaseWrite()
+        
+    @_writer
+    def revertJournal(self, journal):
+        """
+        Undo the mutations recorded in a journal, in O(changes). A journal already reverted is left as it is
+        """
+        if journal.reverted:
+            return
+        for record in reversed(journal):
+            if record[0]=="addNode":
+                self._removeNode(record[1])
+            elif record[0]=="setNode":
+                self._setNode(record[1], record[2], True)
+            elif record[0]=="removeNode":
+                self._addNode(record[1], record[2])
+            elif record[0]=="addEdge":
+                self._removeEdge(record[1])
+            elif record[0]=="removeEdge":
+                self._addEdge(record[2], record[3], record[4], record[1])
+            elif record[0]=="journal":
+                self.revertJournal(record[1])
+            elif record[0]=="reverted":
+                record[1].reverted = False
+        journal.reverted = True
+        self._record("reverted", journal)
+                
+    #Primitive mutations. All the changes to the graph go through these, to keep indexes and journal up to date.
+    #Stored nodes are never modified in place, since they can be shared with forks and journals
+    def _record(self, *record):
+        if self._journals:
+            self._journals[-1].append(record)
+            
+    def _indexNode(self, eid):
+        node = self._graph[eid]
+        self._nodes.add(eid, node["type"], node["label"])
+        self._properties.update(eid, node)
+        self._spatial.update(eid, node)
+        
+    def _addNode(self, eid, props, index=True):
+        node = dict(props)
+        node["id"] = eid
+        self._graph[eid] = node
+        self._claimId(eid)
+        if index:
+            self._indexNode(eid)
+        self._record("addNode", eid)
+        
+    def _setNode(self, eid, props, replace=False):
+        old = self._graph[eid]
+        self._record("setNode", eid, old)
+        if replace:
+            node = dict(props)
+        else:
+            node = dict(old)
+            node.update(props)
+        node["id"] = eid
+        self._graph[eid] = node
+        self._indexNode(eid)
+        
+    def _removeNode(self, eid):
+        #The id can be reused by a new node, forget the relations computed on it
+        if self._reasoned:
+            self._forgetReasoned(eid)
+        for edge_id in self._relations.getIncident(eid):
+            self._removeEdge(edge_id)
+        self._record("removeNode", eid, self._graph.pop(eid))
+        self._releaseId(eid)
+        self._nodes.remove(eid)
+        self._properties.remove(eid)
+        self._spatial.remove(eid)
+        
+    def _addEdge(self, esubject, relation, eobject, edge_id=None):
+        if not esubject in self._graph or not eobject in self._graph:
+            raise KeyError("Edge {} {} {}: node not found".format(esubject, relation, eobject))
+        if edge_id is None:
+            edge_id = self._edge_id
+            self._edge_id += 1
+        self._relations.add(edge_id, esubject, relation, eobject)
+        if relation in self._getContainTypes():
+            self._tree.add(esubject, eobject)
+        if self._matrices is not None:
+            self._matrices.update(esubject, relation, eobject)
+        self._record("addEdge", edge_id)
+        return edge_id
+        
+    def _removeEdge(self, edge_id):
+        esubject, relation, eobject = self._relations.get(edge_id)
+        self._record("removeEdge", edge_id, esubject, relation, eobject)
+        self._relations.remove(edge_id)
+        if relation in self._getContainTypes():
+            self._tree.remove(esubject, eobject)
+        if self._matrices is not None:
+            self._matrices.update(esubject, relation, eobject)
+        
+    @_reader
+    def writeModel(self, stream, root=0, max_depth=None, element_filter=None):
+        """
+        Write the containment tree under root to a file-like object, one element per line
+
+        max_depth: the deepest level written (root is level 0), None for no limit
+        element_filter: a function of the element, if it returns False the element and its subtree are skipped
+        """
+        if not root in self._graph:
+            log.error("writeModel", "{} not found.".format(root))
+            return
+        stack = [(root, "", 0)]
+        while stack:
+            eid, indend, depth = stack.pop()
+            e = self._makeElement(self._graph[eid])
+            if element_filter is not None and not element_filter(e):
+                continue
+            s = e.printState()
+            stream.write(indend + s + "\n")
+            if max_depth is None or depth<max_depth:
+                indend = "-"*(len(indend)+len(s))+"->"
+                for c in reversed(self._tree.getChildren(eid)):
+                    stack.append((c, indend, depth+1))
+        
+    @_reader
     def printModel(self):
-        root = self.getElement(0)
-        #print str(self._graph) 
-        to_ret = ""
-        to_ret = self._printRecursive(to_ret, root, "")
-        #nx.draw(self._graph.networkx_graph())
-        return to_ret
+        to_ret = StringIO()
+        self.writeModel(to_ret)
+        return to_ret.getvalue()
         
     def getAbstractElement(self, etype, elabel):
         e = Element(etype, elabel)
         self.addElement(e, 0, 'hasAbstract')
         return e
     
+    @_reader
     def resolveElements(self, keys, ph):
         """
         Return all elements matching the profile in input (type, label, properties and relations)
@@ -226,252 +1310,342 @@ class WorldModel:
         Keys: a key list pointing out the params to be resolved
         ph: a ParamHandler class     
         
+        Params linked by relations are solved together as a join: the result has a tuple of keys and an
+        array of rows, one element per key. The other keys get the array of their candidates.
         """
-        first = {}
+        import numpy as np
+        first, groups, domains = self._prepareResolve(keys, ph)
         couples = {}
-        print_out = False
+        for component in groups:
+            ckeys, rows = self._join(component, domains, ph)
+            couples[ckeys] = rows
+        #Add back keys that are not coupled to others
+        for key in keys:
+            if not key in domains:
+                couples[key] = np.array(first[key])
+        return couples
+        
+    def iterGroundings(self, keys, ph, failure=None):
+        """
+        Yield the bindings of the params consistent with all the constraints, one at a time
+        
+        A binding maps each key, or tuple of keys linked by relations, to its element (tuple of elements),
+        like a row of resolveElements. Bindings are found by backtracking, in the same order as the rows
+        of resolveElements: the first binding picks the first row of every entry.
+        
+        If there is no binding and failure is a list, the entry that can't be grounded is appended to it:
+        the first entry without candidates or, if all have some, the one where the search fails
+        """
+        slots = self._getSlots(keys, ph)
+        row = {}
+        deepest = [0]
+        found = False
+        for _ in self._backtrack(slots, 0, row, deepest):
+            found = True
+            binding = {}
+            for entry, _, _, _ in slots:
+                if not entry in binding:
+                    binding[entry] = tuple(row[k] for k in entry) if isinstance(entry, tuple) else row[entry]
+            yield binding
+        if not found and failure is not None:
+            empty = [entry for entry, _, candidates, _ in slots if not candidates]
+            failure.append(empty[0] if empty else slots[deepest[0]][0])
+            
+    @_reader
+    def _getSlots(self, keys, ph):
+        """
+        Return the keys to bind in order, as (entry, key, candidates, checks on the keys bound before)
+        
+        The backtracking works only on the slots, without reading the world model
+        """
+        first, groups, domains = self._prepareResolve(keys, ph)
+        slots = []
+        for component in groups:
+            ckeys, ids, arcs = self._propagate(component, domains, ph)
+            ckeys = tuple(ckeys)
+            for i, k in enumerate(ckeys):
+                checks = []
+                for key, key2, forward, backward in arcs:
+                    if key2==k and key in ckeys[:i]: checks.append((key, forward))
+                    if key==k and key2 in ckeys[:i]: checks.append((key2, backward))
+                slots.append((ckeys, k, [e for e in domains[k] if e._id in ids[k]], checks))
+        for key in keys:
+            if not key in domains:
+                slots.append((key, key, first[key], []))
+        return slots
+            
+    def _backtrack(self, slots, i, row, deepest=None):
+        if deepest is not None and i>deepest[0]:
+            deepest[0] = i
+        if i==len(slots):
+            yield row
+            return
+        _, k, candidates, checks = slots[i]
+        for e in candidates:
+            if all(e._id in adjacency.get(row[other]._id, ()) for other, adjacency in checks):
+                row[k] = e
+                for r in self._backtrack(slots, i+1, row, deepest):
+                    yield r
+        row.pop(k, None)
+        
+    def _prepareResolve(self, keys, ph):
+        """
+        Return the candidates of the keys, the groups of linked constraints and the domains of the constrained keys
+        """
+        first = {}
         for key in keys:
-            first[key] = np.array(self.resolveElement(ph.getParamValue(key)))
-            if not first[key].any():
+            first[key] = self.resolveElement(ph.getParamValue(key))
+            if not first[key]:
                 log.warn("resolveElements", "No input found for param {}. Resolving: {}".format(key, ph.getParamValue(key).printState(True)))
-        all_keys = [key for key, _ in ph._params.iteritems()]
-        coupled_keys = []
-        overlap_keys = []
+        constraints = self._getConstraints(ph)
+        #Domains of the constrained keys: the param itself if set, otherwise the candidates
+        domains = {}
+        for key, _, key2, _ in constraints:
+            for k in (key, key2):
+                if not k in domains:
+                    value = ph.getParamValue(k)
+                    if value._id>=0:
+                        domains[k] = [value]
+                    elif k in first:
+                        domains[k] = first[k]
+                    else:
+                        domains[k] = self.resolveElement(value)
+        return first, self._groupConstraints(constraints), domains
+        
+    def _getConstraints(self, ph):
+        """
+        Return the relation constraints between params, as a list of (key, relation, key2, state)
+        
+        Constraints between two params already set, or involving an optional param not set, are skipped
+        """
+        constraints = []
         relations_done = set([])
-        #Build tuples of concording parameters
-        for i in range(len(all_keys)):#Loop over all keys
-            key_base = all_keys[i]
+        for key_base, _ in ph._params.iteritems():
             if not isinstance(ph.getParamValue(key_base), Element): continue
-            for j in ph.getParamValue(key_base)._relations:#Loop over relation constraints
-                #print j
+            for j in ph.getParamValue(key_base)._relations:
                 if j["src"]==-1:#-1 is the special autoreferencial value
-                    key2 = j["dst"]  
                     key = key_base
-                    rel_id = key_base+j["type"]+j["dst"]
-                    if rel_id in relations_done:#Skip relation with previous indexes, already considered
-                        continue
-                    else:
-                        #print rel_id
-                        relations_done.add(rel_id)
+                    key2 = j["dst"]
                 else:
+                    key = j["src"]
                     key2 = key_base
-                    key = j["src"]     
-                    rel_id = j["src"]+j["type"]+key_base
-                    if rel_id in relations_done:#Skip relation with previous indexes, already considered
-                        continue
-                    else:
-                        #print rel_id
-                        relations_done.add(rel_id)
+                rel_id = key+j["type"]+key2
+                if rel_id in relations_done:#Skip relation with previous indexes, already considered
+                    continue
+                relations_done.add(rel_id)
                 this = ph.getParamValue(key)
                 other = ph.getParamValue(key2)
-                #print "{} {}".format(key, key2)
                 if this._id>=0 and other._id>=0:#If both parameters are already set, no need to resolve..
                     continue
-                if this._id>=0: set1 = [this]
-                else: 
-                    if ph.getParam(key).paramType()==params.ParamTypes.Optional: continue 
-                    else: set1 = first[key]
-                if other._id>=0: set2 = [other]
-                else:
-                    if ph.getParam(key2).paramType()==params.ParamTypes.Optional: continue 
-                    else: set2 = first[key2]
-                if (key, key2) in couples:
-                    temp = [np.array([e1, e2]) for e1 in set1 for e2 in set2 if bool(self.getRelations(e1._id, j["type"], e2._id)) == j['state']]
-                    if temp:
-                        couples[(key, key2)] = np.concatenate(couples[(key, key2)], np.array(temp))
-                    else:
-                        log.warn("resolveElements", "No input for params {} {}. Resolving: {} {}".format(key, key2, ph.getParamValue(key).printState(True), ph.getParamValue(key2).printState(True)))
-                else:
-                    if key in coupled_keys: overlap_keys.append(key)
-                    else: coupled_keys.append(key)
-                    if key2 in coupled_keys: overlap_keys.append(key2)
-                    else: coupled_keys.append(key2)
-                    temp = [np.array([e1, e2]) for e1 in set1 for e2 in set2 if bool(self.getRelations(e1._id, j["type"], e2._id)) == j['state']]
-                    couples[(key, key2)] = np.array(temp)
-                    if not temp:
-                        log.warn("resolveElements", "No input for params {} {}. Resolving: {} {}".format(key, key2, ph.getParamValue(key).printState(True), ph.getParamValue(key2).printState(True)))
-        #Merge the tuples with an overlapping key
-        if overlap_keys:
-            loop = True
-            iters = 5
-            while loop:#Iterate until no shared keys are found
-                iters-=1
-                if iters==0:
-                    raise
-                loop = False
-                coupled_keys2 = []
-                merged = {}
-                #print 'qui:'
-                for k1, s1 in couples.iteritems():
-                    for k2, s2 in couples.iteritems():
-                        shared_k = [k for k in k1 if k in k2]
-                        if k1==k2 or not shared_k:
-                            continue
-                        loop = True
-                        skip = True
-                        for i in k1:
-                            if not i in coupled_keys2:
-                                coupled_keys2.append(i)
-                                skip=False
-                        for i in k2:
-                            if not i in coupled_keys2:
-                                coupled_keys2.append(i)
-                                skip=False
-                        if skip: continue#If it was already considered, skip
-                        rk, rs = self._intersect2(k1,k2,s1,s2, shared_k)
-                        merged[rk] = rs#Temporary store merged tuple
-                for key in keys:#Add not merged tuples
-                    if not key in coupled_keys2:
-                        for k1, s1 in couples.iteritems():
-                            if key in k1:
-                                merged[k1] = s1 
-                couples = merged   
-        #Add back keys that are not coupled to others
-        for key in keys:
-            if not key in coupled_keys:
-                couples[key] = first[key]
-        if print_out:
-            for k, v in couples.iteritems():
-                s = "{}:".format(k)
-                for i in v:
-                    if not isinstance(i, Element):
-                        s += "["
-                        for j in i:
-                            s += "{},".format(j)
-                        s += "]"
-                    else:                        
-                        s += "{},".format(i)
-                print s
-        return couples
+                if this._id<0 and ph.getParam(key).paramType()==params.ParamTypes.Optional: continue
+                if other._id<0 and ph.getParam(key2).paramType()==params.ParamTypes.Optional: continue
+                constraints.append((key, j["type"], key2, j["state"]))
+        return constraints
         
-    def _checkEqual(self, lst):
-        b = lst[0]
-        for i in range(1, len(lst)):
-            if lst[i]._id!=b._id:
-                return False
-        return True
+    def _groupConstraints(self, constraints):
+        """
+        Split the constraints in groups not sharing any key, keeping their order
+        """
+        groups = []
+        for c in constraints:
+            linked = [g for g in groups if any(c[0] in (d[0], d[2]) or c[2] in (d[0], d[2]) for d in g)]
+            merged = [c]
+            for g in linked:
+                merged = g + merged if len(g)>=len(merged) else merged + g
+                groups.remove(g)
+            groups.append(sorted(merged, key=constraints.index))
+        groups.sort(key=lambda g: constraints.index(g[0]))
+        return groups
         
-    def _checkEqual2(self, lst):
-        return lst[1:] == lst[:-1]
-        
-    def _removeConstants(self, k1, s1, shared_i):
-        r, c = s1.shape
-        if r<=1:
-            return k1, s1
-        c_index = np.ones(c)
-        c_index[shared_i] = 1
-        for i in range(c):
-            if i==shared_i:
-                continue
-            if not self._checkEqual(s1[:,i]):
-                c_index[i] = 0
-        if np.count_nonzero(c_index)<=0:
-            return k1, s1
-        k1 = [k1[i] for i in range(r) if c_index[i]==1]
-        s1 = [s1[:, i] for i in range(r) if c_index[i]==1]
-        #print 'new keys ' + str(k1)
-        #for i in range(size):
-        #    if r_index[i]:
-        return k1, s1
-       
-    def _concatenate(self, a, b):
-        if not isinstance(a, np.ndarray):
-            a = np.array([a])
-        if not isinstance(b, np.ndarray):
-            b = np.array([b])
-        return np.concatenate((a,b))
-       
-    def _intersect2(self, k1, k2, s1, s2, shared_k):
-        #k1, s1 = self._removeConstants(k1, s1, k1.index(shared_k[0]))
-        #k2, s2 = self._removeConstants(k2, s2, k2.index(shared_k[0]))
-        #print k1
-        #print k2
-        a = [k1.index(k) for k in shared_k]
-        b = [k2.index(k) for k in shared_k]
-        c = np.arange(len(k1))
-        d = np.arange(len(k2))
-        d = np.delete(d, b)
+    def _getAllowed(self, domain1, relation, domain2, state):
+        """
+        Return a map from each id in domain1 to the set of ids in domain2 that satisfy the relation constraint
+        """
+        ids2 = set(e._id for e in domain2)
+        allowed = {}
+        reasoner = getReasoner(relation)
+        if reasoner:
+            #Relations computed on the fly can't be looked up in the index, unless the reasoner answers range queries
+            for e1 in domain1:
+                related = reasoner.queryRelated(self, e1, relation)
+                if related is not None:
+                    allowed[e1._id] = related & ids2 if state else ids2 - related
+                    continue
+                allowed[e1._id] = set(e2._id for e2 in domain2 if bool(self.getRelations(e1._id, relation, e2._id)) == state)
+            return allowed
+        if self._matrices is not None and domain1 and domain2:
+            related = self._matrices.related(self._relations, self._getRelationTypes(relation), [e._id for e in domain1], [e._id for e in domain2])
+            for i, related_ids in related.iteritems():
+                allowed[i] = related_ids if state else ids2 - related_ids
+            return allowed
+        rtypes = self._getRelationTypes(relation)
+        for e1 in domain1:
+            related = set(self._relations.get(eid)[2] for eid in self._relations.find(e1._id, rtypes, -1))
+            if state:
+                allowed[e1._id] = related & ids2
+            else:
+                allowed[e1._id] = ids2 - related
+        return allowed
+        
+    def _propagate(self, constraints, domains, ph):
+        """
+        Return the keys of a group, the ids of their candidates pruned to arc consistency, and the
+        constraints as (key, key2, forward adjacency, backward adjacency)
+        """
         keys = []
-        #Remove constant sets
-        for k in k1:
-            keys.append(k)
-        for k in k2:
-            if not k in shared_k:
-                keys.append(k)
-        #print keys
-        sets = []
-        #print c
-        #print d
-        for v1 in s1:
-            for v2 in s2:
-                append=True
-                for i in range(len(shared_k)):
-                    #print str(v1[a[i]].printState()) + 'vs' + str(v1[b[i]].printState()) + '=' + str(v1[a[i]]!=v2[b[i]])
-                    if v1[a[i]]!=v2[b[i]]:
-                        append=False
-                if append:
-                    sets.append(np.array(self._concatenate(v1[c], v2[d])))
-        return tuple(keys), np.array(sets)
-        
-    def _intersect(self, *d):
-        sets = iter(map(set, d))
-        result = sets.next()
-        for s in sets:
-            result = result.intersection(s)
-        return result
-       
+        for key, _, key2, _ in constraints:
+            for k in (key, key2):
+                if not k in keys:
+                    keys.append(k)
+        ids = dict((k, set(e._id for e in domains[k])) for k in keys)
+        #Forward and backward adjacency of every constraint
+        arcs = []
+        for key, relation, key2, state in constraints:
+            forward = self._getAllowed(domains[key], relation, domains[key2], state)
+            backward = {}
+            for id1, id2s in forward.iteritems():
+                for id2 in id2s:
+                    backward.setdefault(id2, set()).add(id1)
+            arcs.append((key, key2, forward, backward))
+            if not any(forward.itervalues()):
+                log.warn("resolveElements", "No input for params {} {}. Resolving: {} {}".format(key, key2, ph.getParamValue(key).printState(True), ph.getParamValue(key2).printState(True)))
+        #Arc consistency: remove the candidates without support in a linked key
+        changed = True
+        while changed:
+            changed = False
+            for key, key2, forward, backward in arcs:
+                for k, adjacency, other in ((key, forward, key2), (key2, backward, key)):
+                    supported = set(i for i in ids[k] if not ids[other].isdisjoint(adjacency.get(i, ())))
+                    if len(supported)<len(ids[k]):
+                        ids[k] = supported
+                        changed = True
+        return keys, ids, arcs
+        
+    def _join(self, constraints, domains, ph):
+        """
+        Return the keys and the rows of elements satisfying all the constraints of a group
+
+        Domains are first pruned to arc consistency, then joined starting from the most selective key.
+        Rows are sorted as the candidates of the keys, so the first row is the same whatever the join order.
+        """
+        keys, ids, arcs = self._propagate(constraints, domains, ph)
+        #Join, extending the partial rows with the most selective linked key
+        order = [min(keys, key=lambda k: len(ids[k]))]
+        rows = [{order[0] : i} for i in ids[order[0]]]
+        while len(order)<len(keys) and rows:
+            linked = set()
+            for key, key2, _, _ in arcs:
+                if key in order and not key2 in order: linked.add(key2)
+                if key2 in order and not key in order: linked.add(key)
+            k = min(linked, key=lambda k: len(ids[k]))
+            joins = []
+            for key, key2, forward, backward in arcs:
+                if key2==k and key in order: joins.append((key, forward))
+                if key==k and key2 in order: joins.append((key2, backward))
+            extended = []
+            for row in rows:
+                candidates = ids[k]
+                for other, adjacency in joins:
+                    candidates = candidates & adjacency.get(row[other], set())
+                for i in candidates:
+                    new_row = dict(row)
+                    new_row[k] = i
+                    extended.append(new_row)
+            rows = extended
+            order.append(k)
+        position = dict((k, dict((e._id, i) for i, e in enumerate(domains[k]))) for k in keys)
+        rows.sort(key=lambda row: [position[k][row[k]] for k in keys])
+        elements = dict((k, dict((e._id, e) for e in domains[k])) for k in keys)
+        import numpy as np
+        to_ret = np.empty((len(rows), len(keys)), dtype=object)
+        for i, row in enumerate(rows):
+            for j, k in enumerate(keys):
+                to_ret[i, j] = elements[k][row[k]]
+        return tuple(keys), to_ret
+        
     def isOfType(self, element, etype):
-        return element._type==etype or (STMN[element._type] in getSubClasses(STMN[etype], True))
+        return element._type==etype or isSubClass(STMN[element._type], STMN[etype])
        
+    @_reader
     def resolveElement(self, description):
         """
         Return all elements matching the profile in input (type, label, properties)
         """
-        first = []
         to_ret = []
-        #Get all nodes matching type and label
-        #print getSubClasses(STMN[description._type], True)
-        for _, e in self._graph.get_nodes().items():
-            type_match = e['type']==description._type or (STMN[e['type']] in getSubClasses(STMN[description._type], True))
-            if type_match and (description._label=="" or description._label=="Unknown" or e['label']==description._label):
-                first.append(self._makeElement(e))
-        #Filter by properties
-        for e in first:
+        #Get the nodes matching type and label from the index
+        if description._label=="" or description._label=="Unknown":
+            candidates = self._nodes.find(getSubTypes(description._type))
+        else:
+            candidates = self._nodes.find(getSubTypes(description._type), description._label)
+        #Intersect with the nodes matching the properties
+        matches = self._matchProperties(description)
+        if matches is not None:
+            candidates = [eid for eid in candidates if eid in matches]
+        #Check the properties not covered by the index, before copying the element
+        for eid in candidates:
+            e = self._graph[eid]
             add = True
             for k, p in description._properties.iteritems():
-                if not e.hasProperty(k):
+                if not k in e:
                     add = False
                     break
                 for v in p.getValues(): 
                     if v == "" or v==None:
                         break
-                    if not v in e.getPropertyValue(k):
+                    if not v in e[k].getValues():
                         add = False
                         break
                 if not add:
                     break
             if add:
-                to_ret.append(e)
+                to_ret.append(self._makeElement(e))
         return to_ret
 
+    def _matchProperties(self, description):
+        """
+        Return the set of node ids having all the properties of the description, or None if unconstrained
+        """
+        sets = []
+        for k, p in description._properties.iteritems():
+            values = []
+            for v in p.getValues(): 
+                if v == "" or v==None:
+                    break
+                values.append(v)
+            if not values:
+                sets.append(self._properties.find(k))
+            for v in values:
+                s = self._properties.find(k, v)
+                if s is not None:
+                    sets.append(s)
+        if not sets:
+            return None
+        sets.sort(key=len)
+        to_ret = set(sets[0])
+        for s in sets[1:]:
+            to_ret = set(eid for eid in to_ret if eid in s)
+        return to_ret
+    
     def _makeElement(self, props):
-        e = Element()
-        copy = deepcopy(props)
-        e._id = copy.pop("id")
-        e._type = copy.pop("type")
-        e._label = copy.pop("label")
-        e._properties = copy
+        """
+        Return a read-only view on the stored node. The properties are copied only if the element is modified
+        """
+        e = Element(props["type"], props["label"], props["id"])
+        e._properties = dict((k, v) for k, v in props.iteritems() if not k in PropertyIndex._reserved)
+        e._shared = True
         return e
     
+    @_reader
     def getElement(self, eid):
-        eprops = self._graph.get_node(eid)
+        eprops = self._graph.get(eid)
         if not eprops:
             log.error("getElement", "{} not found.".format(eid))
             return Element()
         return self._makeElement(eprops)
         
+    @_writer
     def addElement(self, element, parent_id, relation):
-        if not self._graph.has_node(parent_id):
+        if not parent_id in self._graph:
             log.warn("addElement", "No parent element found with key {}".format(parent_id))
             return
         eid = self.generateId(element._id)
@@ -479,75 +1653,221 @@ class WorldModel:
             log.debug('add', str(eid))
         element._id = eid
         props = { "type" : element._type, "label" : element._label}
-        self._graph.add_node(dict(chain(props.items(),element._properties.items())), element._id)
+        self._addNode(eid, dict(chain(props.items(),element._properties.items())))
+        element._shared = True
         self.setRelation(parent_id, relation, eid, True)
         return eid
         
+    @_writer
+    def addElements(self, elements):
+        """
+        Add many elements in one pass
+
+        elements: a list of (element, parent, relation). The parent is an element id, or an element added before in the same batch
+
+        Return the list of the new ids (None for the elements skipped because the parent is missing).
+        Type and property indexes are updated once at the end of the batch.
+        """
+        to_ret = []
+        added = []
+        try:
+            for element, parent, relation in elements:
+                parent_id = parent._id if isinstance(parent, Element) else parent
+                if not parent_id in self._graph:
+                    log.warn("addElements", "No parent element found with key {}".format(parent_id))
+                    to_ret.append(None)
+                    continue
+                eid = self.generateId(element._id)
+                if self._verbose:
+                    log.debug('add', str(eid))
+                element._id = eid
+                props = { "type" : element._type, "label" : element._label}
+                self._addNode(eid, dict(chain(props.items(),element._properties.items())), False)
+                added.append(eid)
+                element._shared = True
+                #A new node has no edges, no need to check the tree structure
+                self._addEdge(parent_id, relation, eid)
+                to_ret.append(eid)
+        finally:
+            for eid in added:
+                self._indexNode(eid)
+        return to_ret
+        
+    @_writer
     def updateElement(self, element):
-        if not self._graph.has_node(element._id):
+        if not element._id in self._graph:
             log.warn("updateElement", "No element found with key {}".format(element._id))
             return
         props = { "type" : element._type, "label" : element._label}
-        self._graph.add_node(dict(chain(props.items(),element._properties.items())), element._id)
+        self._setNode(element._id, dict(chain(props.items(),element._properties.items())))
+        element._shared = True
         
+    @_writer
     def removeElement(self, eid):
         if self._verbose:
             log.debug('remove', str(eid))
         #self._id=0
-        self._graph.remove_node(eid)
+        self._removeNode(eid)
+        
+    def _getContainTypes(self):
+        if self._contain_types is None:
+            self._contain_types = self._getRelationTypes("contain")
+        return self._contain_types
         
     def _checkRelation(self, esubject, relation, eobject, value):
         """
         Remove the old contain relation, to maintain the tree structure
         """
-        if(relation=="contain" and value):  
-            self.setRelation(-1, relation, eobject, False)
+        if value and relation in self._getContainTypes():
+            for e in self._relations.find(-1, self._getContainTypes(), eobject):
+                self._removeEdge(e)
             
         
+    @_writer
     def setRelation(self, esubject, relation, eobject, value=True):
         self._checkRelation(esubject, relation, eobject, value)
         try:
             if value:
-                self._graph.add_edge(esubject, eobject, { "type" : relation })
+                self._addEdge(esubject, relation, eobject)
             else:
                 for e in self.getRelations(esubject, relation, eobject, True):
-                    self._graph.remove_edge(e)
+                    self._removeEdge(e)
         except:
             self.printModel()
             raise
         return True
         
+    @_writer
+    def setRelations(self, relations):
+        """
+        Set or remove many relations in one pass
+
+        relations: a list of (subject id, relation, object id, value)
+
+        Relations with a missing subject or object are skipped. Return the number of relations applied
+        """
+        to_ret = 0
+        types = {}
+        for esubject, relation, eobject, value in relations:
+            if not esubject in self._graph or not eobject in self._graph:
+                log.warn("setRelations", "No element found for relation {} {} {}".format(esubject, relation, eobject))
+                continue
+            if not relation in types:
+                types[relation] = self._getRelationTypes(relation)
+            if value:
+                self._checkRelation(esubject, relation, eobject, value)
+                self._addEdge(esubject, relation, eobject)
+            else:
+                for e in self._relations.find(esubject, types[relation], eobject):
+                    self._removeEdge(e)
+            to_ret += 1
+        return to_ret
+        
     def getAssociatedReasoner(self, relation):
-        for cls in DiscreteReasoner.__subclasses__():
-            instance = cls()
-            if relation in instance.getAssociatedRelations():
-                return instance
-        return None
+        return getReasoner(relation)
+        
+    def _computeRelations(self, reasoner, relation, esubject, eobject):
+        """
+        Return the relations computed by a reasoner between two elements
+        
+        Results are memoized until one of the properties associated to the reasoner changes. Stored
+        properties are never modified in place, so an unchanged property is the same object.
+        """
+        ssubject = self._graph.get(esubject)
+        sobject = self._graph.get(eobject)
+        if ssubject is None or sobject is None:
+            return reasoner.computeRelations(self.getElement(esubject), self.getElement(eobject))
+        versions = tuple(node.get(p) for node in (ssubject, sobject) for p in reasoner.getAssociatedProperties())
+        key = (relation, esubject, eobject)
+        with self._reasoned_mutex:
+            cached = self._reasoned.pop(key, None)
+        if cached is None or len(cached[0])!=len(versions) or any(a is not b for a, b in zip(cached[0], versions)):
+            cached = (versions, reasoner.computeRelations(self._makeElement(ssubject), self._makeElement(sobject)))
+        with self._reasoned_mutex:
+            #Reinserted at the end, the most recently used
+            self._reasoned[key] = cached
+            self._reasoned_keys.setdefault(esubject, set()).add(key)
+            self._reasoned_keys.setdefault(eobject, set()).add(key)
+            while len(self._reasoned)>self._max_reasoned:
+                old, _ = self._reasoned.popitem(last=False)
+                for eid in old[1:]:
+                    self._reasoned_keys.get(eid, set()).discard(old)
+        return [dict(r) for r in cached[1]]
+        
+    def _forgetReasoned(self, eid):
+        """
+        Drop the memoized relations of an element
+        """
+        with self._reasoned_mutex:
+            for key in self._reasoned_keys.pop(eid, ()):
+                if self._reasoned.pop(key, None) is not None:
+                    other = key[2] if key[1]==eid else key[1]
+                    self._reasoned_keys.get(other, set()).discard(key)
         
+    def _getRelationTypes(self, relation):
+        """
+        Return the set of predicates matching a relation (the relation and its sub-properties), or None to match any
+        """
+        if not relation:
+            return None
+        types = set([relation])
+        #The hierarchy is indexed by URI, while edges store the bare name
+        for p in getSubProperties(STMN[relation], True):
+            if p.startswith(STMN):
+                types.add(p[len(STMN):])
+        return types
+        
+    @_reader
     def getRelations(self, esubject, relation, eobject, getId=False):
         rel = []
-        for _, edge in self._graph.get_edges().items():
-            if (esubject<0 or edge['src']==esubject) and (eobject<0 or edge['dst']==eobject) and (not relation or edge['type']==relation or STMN[edge['type']] in getSubProperties(relation, True)):
-                if getId:
-                    rel.append(edge['id'])
-                else:
-                    new_edge = deepcopy(edge)
-                    rel.append(new_edge)
-        reasoner = self.getAssociatedReasoner(relation)
+        for edge_id in self._relations.find(esubject, self._getRelationTypes(relation), eobject):
+            if getId:
+                rel.append(edge_id)
+            else:
+                src, rtype, dst = self._relations.get(edge_id)
+                rel.append({'id': edge_id, 'src': src, 'type': rtype, 'dst': dst})
+        reasoner = getReasoner(relation)
         if reasoner and esubject>=0 and eobject>=0:
-            rel += reasoner.computeRelations(self.getElement(esubject), self.getElement(eobject))
+            rel += self._computeRelations(reasoner, relation, esubject, eobject)
         return rel
         
+    @_reader
+    def getElementsInRange(self, center, radius):
+        """
+        Return the elements with a Position closer than radius to center (a list of coordinates)
+        """
+        return [self._makeElement(self._graph[eid]) for eid in sorted(self._spatial.findInRange(center, radius))]
+        
+    @_reader
+    def getNearby(self, eid, radius):
+        """
+        Return the elements with a Position closer than radius to the position of the element eid (excluded)
+        """
+        center = self._spatial.getPosition(eid)
+        if center is None:
+            return []
+        return [e for e in self.getElementsInRange(center, radius) if e._id!=eid]
+        
+    @_reader
     def getChildren(self, eid):
-        to_ret=[]
-        for edge in self.getRelations(eid, "contain", -1):
-            e = self.getElement(edge['dst'])
-            to_ret.append(e)
-        return to_ret
+        return [self._makeElement(self._graph[c]) for c in self._tree.getChildren(eid)]
         
+    @_reader
     def getParent(self, eid):
-        for edge in self.getRelations(-1, "contain", eid):
-            return self.getElement(edge['dst'])   
+        """
+        Return the element containing eid, or None
+        """
+        parent = self._tree.getParent(eid)
+        if parent is None:
+            return None
+        return self._makeElement(self._graph[parent])
+        
+    @_reader
+    def isInside(self, eid, container):
+        """
+        Return true if eid is contained, directly or indirectly, in container
+        """
+        return self._tree.isAncestor(container, eid)
 
 
 if __name__ == '__main__':
@@ -557,7 +1877,7 @@ if __name__ == '__main__':
     #g.bind("stmn", STMN)    
     #print( g.serialize(format='n3') )
     #print XSD
-    if STMN["GraspingPose"] in getSubClasses(STMN["Spatial"], True): 
+    if isSubClass(STMN["GraspingPose"], STMN["Spatial"]): 
         print STMN["GraspingPose"]
     #for x in getSubProperties(STMN["sceneProperty"], True): print x
     #for x in set(g.objects(STMN["compressor"], RDF["type"])): print x
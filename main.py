@@ -6,7 +6,6 @@
 
 Requires:
 pip install rdflib
-pip install semanticnet
 """
 
 import core as skiros
@@ -161,7 +160,7 @@ if __name__ == '__main__':
         file.write("Initial scene:\n")
         print "Initial scene:"
         print wmi.printModel()
-        file.write(wmi.printModel())
+        wmi.writeModel(file)
         print "Standard sequence:"
         file.write("Standard sequence:\n")
         file.write(sm.taskPrint(p))
@@ -171,3 +170,6 @@ if __name__ == '__main__':
         file.write(sm.taskPrint(p2))
         print sm.taskPrint(p2)
     
+    #Condition evaluation statistics
+    with open('results/conditions.txt', 'w') as file:
+        skiros.cond.writeStatistics(file)
@@ -0,0 +1,55 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import core as skiros
+
+class TestRevert(unittest.TestCase):
+    def setUp(self):
+        self.wm = skiros.wm.WorldModel("test")
+        gripper = skiros.wm.Element("Gripper", "gripper")
+        gripper.addProperty("ContainerState", "Full")
+        self.wm.addElement(gripper, 0, "contain")
+        self.ph = skiros.params.ParamHandler()
+        self.ph.addParam("Gripper", gripper, skiros.params.ParamTypes.Online)
+        self.ph.addParam("Cell", skiros.wm.Element("Cell"), skiros.params.ParamTypes.Optional)
+        self.empty = skiros.cond.ConditionProperty("Empty", "ContainerState", "Gripper", "Empty", True)
+        self.generate = skiros.cond.ConditionGenerate("Generate", "Cell", True)
+
+    def getState(self):
+        return self.wm.getElement(self.ph.getParamValue("Gripper")._id).getPropertyValue("ContainerState")
+
+    def getLabels(self):
+        return sorted(e._label for e in self.wm.getChildren(0))
+
+    def testRevertAfterOuterCommit(self):
+        with self.wm:
+            record = self.empty.setTrue(self.ph, self.wm)
+            generated = self.generate.setTrue(self.ph, self.wm)
+        self.assertEqual(self.getState(), ["Full", "Empty"])
+        self.assertEqual(self.getLabels(), ["==FAKE==", "gripper"])
+        self.generate.revert(self.ph, self.wm, generated)
+        self.empty.revert(self.ph, self.wm, record)
+        self.assertEqual(self.getState(), ["Full"])
+        self.assertEqual(self.getLabels(), ["gripper"])
+
+    def testRevertAfterOuterRollback(self):
+        self.wm.startTransaction()
+        record = self.empty.setTrue(self.ph, self.wm)
+        generated = self.generate.setTrue(self.ph, self.wm)
+        self.wm.rollbackTransaction()
+        self.generate.revert(self.ph, self.wm, generated)
+        self.empty.revert(self.ph, self.wm, record)
+        self.assertEqual(self.getState(), ["Full"])
+        self.assertEqual(self.getLabels(), ["gripper"])
+
+    def testOuterRollbackAfterRevert(self):
+        self.wm.startTransaction()
+        record = self.empty.setTrue(self.ph, self.wm)
+        self.empty.revert(self.ph, self.wm, record)
+        self.empty.setTrue(self.ph, self.wm)
+        self.wm.rollbackTransaction()
+        self.assertEqual(self.getState(), ["Full"])
+
+if __name__ == '__main__':
+    unittest.main()
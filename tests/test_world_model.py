@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import core as skiros
+
+class TestRelations(unittest.TestCase):
+    def setUp(self):
+        self.wm = skiros.wm.WorldModel("test")
+        self.box = skiros.wm.Element("LargeBox", "box")
+        self.wm.addElement(self.box, 0, "contain")
+        self.cell = skiros.wm.Element("Cell", "cell")
+        self.wm.addElement(self.cell, 0, "contain")
+
+    def testSuperPropertyMatchesSubProperties(self):
+        self.wm.setRelation(self.box._id, "left", self.cell._id, True)
+        self.wm.setRelation(self.box._id, "contain", self.cell._id, True)
+        types = sorted(r['type'] for r in self.wm.getRelations(self.box._id, "spatiallyRelated", self.cell._id))
+        self.assertEqual(types, ["contain", "left"])
+
+    def testSubPropertyDoesNotMatchSuperProperty(self):
+        self.wm.setRelation(self.box._id, "left", self.cell._id, True)
+        self.assertEqual(self.wm.getRelations(self.box._id, "right", self.cell._id), [])
+
+class TestIds(unittest.TestCase):
+    def setUp(self):
+        self.wm = skiros.wm.WorldModel("test")
+
+    def testDesiredIdAboveTheLast(self):
+        self.assertEqual(self.wm.addElement(skiros.wm.Element("Cell", "far", 10**6), 0, "contain"), 10**6)
+        self.assertEqual(self.wm.addElement(skiros.wm.Element("Cell", "next"), 0, "contain"), 10**6+1)
+        self.assertEqual(self.wm.addElement(skiros.wm.Element("Cell", "gap", 5), 0, "contain"), 5)
+
+    def testReleasedIdIsReused(self):
+        eid = self.wm.addElement(skiros.wm.Element("Cell", "cell"), 0, "contain")
+        self.wm.removeElement(eid)
+        self.assertEqual(self.wm.addElement(skiros.wm.Element("Cell", "other"), 0, "contain"), eid)
+
+class TestReasoned(unittest.TestCase):
+    def setUp(self):
+        self.wm = skiros.wm.WorldModel("test")
+        self.ids = []
+        for i in range(3):
+            e = skiros.wm.Element("Cell", "cell")
+            e.addProperty("Position", 0.0)
+            e.appendProperty("Position", 0.1*i)
+            self.ids.append(self.wm.addElement(e, 0, "contain"))
+
+    def testRemovalForgetsOnlyTheRemovedElement(self):
+        a, b, c = self.ids
+        self.assertEqual(len(self.wm.getRelations(a, "near", b)), 1)
+        self.assertEqual(len(self.wm.getRelations(a, "near", c)), 1)
+        self.wm.removeElement(c)
+        self.assertEqual(self.wm._reasoned.keys(), [("near", a, b)])
+        reused = self.wm.addElement(skiros.wm.Element("Cell", "far"), 0, "contain")
+        self.assertEqual(reused, c)
+        self.assertEqual(self.wm.getRelations(a, "near", reused), [])
+
+if __name__ == '__main__':
+    unittest.main()